@@ -0,0 +1,235 @@
+"""
+Offline benchmarks of the bot, run against recorded pages of every website
+served by a local http stand-in instead of the live websites.
+
+Usage (from the root of the repository):
+    python benchmarks/bench.py [--rounds 20] [--tolerance 0.5]
+                               [--floor 1] [--update-baseline]
+
+Every benchmark reports its p50/p95 latency and the pages served per second.
+Results are compared with benchmarks/baseline.json and the script exits
+with an error if the p50 latency of any benchmark got worse than the
+baseline by more than the tolerance and by more than the floor, in ms.
+p95 is only reported, being too noisy to compare over a few rounds.
+"""
+from pyhocon import ConfigFactory
+from typing import Callable
+from typing import Dict
+from typing import List
+import argparse
+import http.server
+import json
+import logging
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from fetch import HttpPage  # noqa: E402
+from immoBot import ImmoBot  # noqa: E402
+from immoBot import allSearchersFactory  # noqa: E402
+from immoweb import ImmowebDetailFinder  # noqa: E402
+from immoweb import immowebFactory  # noqa: E402
+from immovlan import ImmovlanDetailFinder  # noqa: E402
+from immovlan import immovlanFactory  # noqa: E402
+from realo import RealoDetailFinder  # noqa: E402
+from realo import realoFactory  # noqa: E402
+
+# rounds of the sub-millisecond benchmarks per round of the others
+MICRO_ROUNDS = 25
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+SITES = {"immoweb": (immowebFactory, ImmowebDetailFinder),
+         "immovlan": (immovlanFactory, ImmovlanDetailFinder),
+         "realo": (realoFactory, RealoDetailFinder)}
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the recorded pages: /<site>/search... gives the list page
+    of the site and /<site>/detail/... its detail page.
+    """
+    served = 0
+
+    def do_GET(self):
+        site, kind = (self.path.strip("/").split("/") + [""])[:2]
+        kind = "list" if kind.startswith("search") else kind
+        path = os.path.join(FIXTURES_DIR, site, f"{kind}.html")
+        if site not in SITES or not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as fixture:
+            body = fixture.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        FixtureHandler.served += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server() -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                             FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_conf(root: str, work_dir: str) -> ConfigFactory:
+    """ Template configuration pointing every website to the stand-in """
+    conf = ConfigFactory.parse_file(os.path.join(ROOT_DIR, "configuration",
+                                                 "template.conf"))
+    conf.put("general.shelve_dir", f"{work_dir}/")
+    conf.put("general.seen_db", f"{work_dir}/seen.sqlite")
+    conf.put("general.detail_cache.path", f"{work_dir}/details.sqlite")
+    conf.put("general.history.path", f"{work_dir}/history.sqlite")
+    # always fetch details again, this is what we want to measure
+    conf.put("general.detail_cache.ttl", 0)
+    # search every time, whatever the polling schedule
+    conf.put("general.polling.adaptive", False)
+    conf.put("immoweb.search_url", f"{root}/immoweb/search?")
+    conf.put("immovlan.search_url", f"{root}/immovlan/search?")
+    conf.put("realo.search_url", f"{root}/realo/search/")
+    for site in SITES:
+        conf.put(f"{site}.engine", "http")
+    return conf
+
+
+def percentile(timings: List[float], percent: float) -> float:
+    ordered = sorted(timings)
+    index = min(len(ordered) - 1, int(round(percent / 100 * len(ordered))))
+    return ordered[index]
+
+
+def measure(rounds: int, action: Callable[[], None],
+            setup: Callable[[], None] = lambda: None) -> Dict[str, float]:
+    timings = []
+    pages = 0
+    for _ in range(rounds):
+        setup()
+        served = FixtureHandler.served
+        start = time.perf_counter()
+        action()
+        timings.append(time.perf_counter() - start)
+        pages += FixtureHandler.served - served
+    return {"p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "pages_per_sec": pages / sum(timings)}
+
+
+def run(rounds: int) -> Dict[str, Dict[str, float]]:
+    server = start_server()
+    root = f"http://127.0.0.1:{server.server_address[1]}"
+    work_dir = tempfile.mkdtemp(prefix="immobot-bench-")
+    results = {}
+    try:
+        conf = bench_conf(root, work_dir)
+        for site, (factory, finder) in SITES.items():
+            with factory(conf) as searcher:
+                results[f"search_all[{site}]"] = measure(
+                    rounds, searcher.search_all)
+                # steady state: every listing was already seen
+                searcher.search_new()
+                results[f"search_new[{site}]"] = measure(
+                    rounds, searcher.search_new)
+                # same, reading every page again as if it had changed
+                results[f"search_reread[{site}]"] = measure(
+                    rounds, searcher.search_new,
+                    setup=searcher.fingerprints.clear)
+            # parsing only, out of an already loaded page
+            url = f"{root}/{site}/detail/1"
+            with open(os.path.join(FIXTURES_DIR, site, "detail.html"),
+                      "rb") as fixture:
+                page = HttpPage(fixture.read(), url)
+            detail_finder = finder(conf)
+            results[f"findDetail[{site}]"] = measure(
+                rounds * MICRO_ROUNDS,
+                lambda: detail_finder.__findDetail__(url, page))
+
+        bot = ImmoBot(conf, allSearchersFactory)
+        searcher = allSearchersFactory(conf)
+
+        def fresh_start():
+            # forget everything so that the whole cycle is exercised
+            for site_searcher in searcher.searchers:
+                site_searcher.fingerprints.clear()
+            for store in ["seen.sqlite", "details.sqlite", "history.sqlite"]:
+                with sqlite3.connect(os.path.join(work_dir, store)) as db:
+                    tables = db.execute("SELECT name FROM sqlite_master "
+                                        "WHERE type = 'table'").fetchall()
+                    for (table, ) in tables:
+                        db.execute(f"DELETE FROM {table}")
+        with searcher:
+            results["job"] = measure(rounds, lambda: bot.job(searcher),
+                                     setup=fresh_start)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]],
+            baseline: Dict[str, Dict[str, float]],
+            tolerance: float, floor: float) -> List[str]:
+    """
+    Benchmarks whose p50 regressed past the tolerance, differences of
+    less than 'floor' seconds being left out as noise.
+    """
+    return [name for name, result in results.items()
+            if name in baseline and
+            result["p50"] > baseline[name]["p50"] * (1 + tolerance) and
+            result["p50"] - baseline[name]["p50"] > floor]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative p50 slow down")
+    parser.add_argument("--floor", type=float, default=1,
+                        help="slow down in ms always allowed")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    results = run(args.rounds)
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+    print(f"{'benchmark':<24}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+          f"{'baseline p50':>14}{'pages/s':>10}")
+    for name, result in results.items():
+        reference = baseline.get(name, {}).get("p50")
+        reference = "-" if reference is None else f"{reference * 1000:.2f}"
+        print(f"{name:<24}{result['p50'] * 1000:>10.2f}"
+              f"{result['p95'] * 1000:>10.2f}{reference:>14}"
+              f"{result['pages_per_sec']:>10.1f}")
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"peak RSS: {peak_rss:.1f} MB")
+    if args.update_baseline:
+        with open(BASELINE, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"Baseline updated in {BASELINE}")
+        return 0
+    regressions = compare(results, baseline, args.tolerance,
+                          args.floor / 1000)
+    if len(regressions) > 0:
+        print(f"Regressions past {args.tolerance:.0%}: {regressions}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
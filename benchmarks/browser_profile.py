@@ -0,0 +1,103 @@
+"""
+Compare the stock and lean headless browser profiles on live pages.
+
+Usage (from the root of the repository, needs firefox, geckodriver and
+network access):
+    python benchmarks/browser_profile.py [--conf configuration/myConf.conf]
+                                         [--rounds 3] [--url URL ...]
+
+Every page (by default the first page of results of every website) is
+loaded 'rounds' times with each profile, in a fresh browser per profile.
+The median load time and bytes transferred of every page are reported.
+"""
+from pyhocon import ConfigFactory
+from typing import Dict
+from typing import List
+import argparse
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from browser import launch_selenium  # noqa: E402
+from immoweb import ImmowebSearcher  # noqa: E402
+from immovlan import ImmovlanSearcher  # noqa: E402
+from realo import RealoSearcher  # noqa: E402
+
+# bytes received for the page and everything it loaded so far
+TRANSFERRED = ("return performance.getEntriesByType('navigation')"
+               ".concat(performance.getEntriesByType('resource'))"
+               ".reduce((total, entry) => total + (entry.transferSize || 0),"
+               " 0);")
+
+
+def default_urls(conf: ConfigFactory) -> List[str]:
+    realo = RealoSearcher(conf)
+    return [ImmowebSearcher(conf).url, ImmovlanSearcher(conf).url,
+            realo.url(realo.postalCodes[0])]
+
+
+def profile(conf: ConfigFactory, lean: bool) -> ConfigFactory:
+    general = ConfigFactory.from_dict(conf["general"].as_plain_ordered_dict())
+    general.put("browser.lean", lean)
+    if not lean:
+        general.put("browser.page_load", "normal")
+    return general
+
+
+def measure(general: ConfigFactory, urls: List[str], rounds: int,
+            settle: float) -> Dict[str, Dict[str, float]]:
+    driver = launch_selenium(general)
+    try:
+        results = {}
+        for url in urls:
+            timings = []
+            transferred = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                driver.get(url)
+                timings.append(time.perf_counter() - start)
+                # let late resources come in, as they would while parsing
+                time.sleep(settle)
+                transferred.append(driver.execute_script(TRANSFERRED))
+                driver.get("about:blank")
+            results[url] = {"seconds": statistics.median(timings),
+                            "bytes": statistics.median(transferred)}
+        return results
+    finally:
+        driver.quit()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--conf", default=os.path.join(
+        ROOT_DIR, "configuration", "template.conf"))
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--settle", type=float, default=2,
+                        help="seconds waited after a page load before "
+                             "counting the bytes transferred")
+    parser.add_argument("--url", action="append", dest="urls")
+    args = parser.parse_args()
+    conf = ConfigFactory.parse_file(args.conf)
+    urls = args.urls or default_urls(conf)
+    stock = measure(profile(conf, False), urls, args.rounds, args.settle)
+    lean = measure(profile(conf, True), urls, args.rounds, args.settle)
+    print(f"{'page':<40}{'stock s':>9}{'lean s':>9}"
+          f"{'stock kB':>10}{'lean kB':>10}")
+    for url in urls:
+        print(f"{url[:39]:<40}"
+              f"{stock[url]['seconds']:>9.2f}{lean[url]['seconds']:>9.2f}"
+              f"{stock[url]['bytes'] / 1024:>10.0f}"
+              f"{lean[url]['bytes'] / 1024:>10.0f}")
+    total = {name: sum([result[url]["bytes"] for url in urls])
+             for name, result in [("stock", stock), ("lean", lean)]}
+    print(f"bytes saved: {1 - total['lean'] / max(1, total['stock']):.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
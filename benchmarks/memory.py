@@ -0,0 +1,113 @@
+"""
+Memory taken by the listings and the seen ids at a large number of
+tracked listings, compared with their former representations.
+
+Usage (from the root of the repository):
+    python benchmarks/memory.py [--listings 1000000]
+
+- details: slotted CompleteDetails against the same dataclass with a
+  per instance __dict__, as it used to be
+- seen ids: the Bloom filter kept in memory in front of the sqlite store
+  against the dict of id: url loaded out of the shelve every search
+"""
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Callable
+from typing import List
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from details import CompleteDetails  # noqa: E402
+from seen import SeenStore  # noqa: E402
+
+
+@dataclass
+class DictDetails:
+    """ CompleteDetails as it was before being slotted """
+    url: str
+    price: int
+    address: str
+    bedrooms: int
+    area: int
+    other_urls: List[str] = field(default_factory=list)
+    price_per_sqm: float = field(init=False)
+
+    def __post_init__(self):
+        self.price_per_sqm = self.price / self.area
+
+
+def listing_id(index: int) -> str:
+    return f"{10000000 + index}"
+
+
+def listing_url(index: int) -> str:
+    return ("https://www.immoweb.be/en/classified/house/for-sale/"
+            f"brussels/1000/{listing_id(index)}")
+
+
+def allocated(build: Callable[[], object]) -> float:
+    """ MB still allocated by what 'build' returns """
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / 2 ** 20
+
+
+def details(cls, listings: int) -> Callable[[], list]:
+    # urls are shared by both representations, only the records count
+    return lambda: [cls("", 1000000 + index, "Rue Royale 21 1000 Brussels",
+                        3, 150) for index in range(listings)]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--listings", type=int, default=1000000)
+    args = parser.parse_args()
+    listings = args.listings
+
+    results = [("details (dict)", allocated(details(DictDetails, listings))),
+               ("details (slots)",
+                allocated(details(CompleteDetails, listings)))]
+    results.append(("seen ids (dict)", allocated(
+        lambda: {listing_id(index): listing_url(index)
+                 for index in range(listings)})))
+
+    work_dir = tempfile.mkdtemp(prefix="immobot-memory-")
+    try:
+        path = os.path.join(work_dir, "seen.sqlite")
+        with SeenStore(path, listings) as store:
+            store.update("immoweb", {listing_id(index): listing_url(index)
+                                     for index in range(listings)})
+        store = SeenStore(path, listings)
+
+        def bloom():
+            # loads the persisted filter, as at the start of a search
+            store.seen("immoweb", [listing_id(listings)])
+            return store.blooms["immoweb"]
+        results.append(("seen ids (bloom)", allocated(bloom)))
+        store.close()
+        disk = os.path.getsize(path) / 2 ** 20
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'at ' + str(listings) + ' listings':<22}{'memory (MB)':>12}")
+    for name, size in results:
+        print(f"{name:<22}{size:>12.1f}")
+    print(f"(seen store on disk: {disk:.1f} MB)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
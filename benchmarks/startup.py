@@ -0,0 +1,82 @@
+"""
+Time taken by the bot to start, each run in a fresh interpreter.
+
+Usage (from the root of the repository):
+    python benchmarks/startup.py [--rounds 10]
+                                 [--conf configuration/template.conf]
+
+- eager imports: every module the bot used to import on startup,
+  whatever the websites searched
+- lazy imports: what the bot imports by now on startup
+- config (parsed): parsing and resolving the configuration file
+- config (cached): reading the cached resolved configuration back
+- cold start: cached configuration, bot and searchers of the websites
+  of the configuration built, up to the first search
+"""
+from typing import Dict
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+
+EAGER = ("import telegram_send, schedule, numpy, requests, selenium.webdriver;"
+         "import immoBot, immoweb, immovlan, realo, analytics, browser")
+LAZY = "import immoBot"
+PARSED = ("from pyhocon import ConfigFactory;"
+          "ConfigFactory.parse_file({conf!r})")
+CACHED = "from config import load_conf; load_conf({conf!r})"
+COLD_START = ("from config import load_conf;"
+              "from immoBot import ImmoBot, allSearchersFactory;"
+              "conf = load_conf({conf!r});"
+              "ImmoBot(conf, allSearchersFactory); allSearchersFactory(conf)")
+
+
+def timed(code: str, work_dir: str) -> float:
+    """ Seconds taken by a fresh interpreter to run code """
+    timer = ("import time; start = time.perf_counter();"
+             f"{code};print(time.perf_counter() - start)")
+    output = subprocess.run([sys.executable, "-c", timer], cwd=work_dir,
+                            env={**os.environ, "PYTHONPATH": SRC_DIR},
+                            check=True, capture_output=True, text=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--conf", default=os.path.join(
+        ROOT_DIR, "configuration", "template.conf"))
+    args = parser.parse_args()
+    conf = os.path.abspath(args.conf)
+    # holds the stores opened by the bot, relative to where it runs
+    work_dir = tempfile.mkdtemp(prefix="immobot-startup-")
+    os.makedirs(os.path.join(work_dir, "shelves"))
+    runs = {"eager imports": EAGER,
+            "lazy imports": LAZY,
+            "config (parsed)": PARSED.format(conf=conf),
+            "config (cached)": CACHED.format(conf=conf),
+            "cold start": COLD_START.format(conf=conf)}
+    results: Dict[str, float] = {}
+    try:
+        # make sure the cached configuration is there
+        timed(CACHED.format(conf=conf), work_dir)
+        for name, code in runs.items():
+            results[name] = statistics.median(timed(code, work_dir)
+                                              for _ in range(args.rounds))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"{'startup':<22}{'p50 (ms)':>10}")
+    for name, duration in results.items():
+        print(f"{name:<22}{duration * 1000:>10.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
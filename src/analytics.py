@@ -0,0 +1,171 @@
+from pyhocon import ConfigFactory
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+import time
+import numpy as np
+from logging import getLogger
+
+from dedup import postal_codes
+from details import CompleteDetails
+from history import PriceHistory
+from history import open_history
+from metrics import metrics
+
+# bedrooms value of the groups holding every number of bedrooms
+ALL_BEDROOMS = 99
+PERCENTILES = np.array([25, 50, 75])
+# seconds after which stats are computed again, even without new listings,
+# for the oldest listings to leave the window
+RECOMPUTE = 3600
+
+
+def group_key(postal_code: int, bedrooms: int) -> int:
+    return postal_code * 100 + bedrooms
+
+
+class MarketStats():
+    """
+    Percentiles of the price per m² of the listings first seen in the last
+    'window' seconds, per postal code and number of bedrooms as well as
+    per postal code only.
+    Listings are loaded from the price history into columnar arrays,
+    only the ones recorded since the previous refresh being read.
+    """
+
+    def __init__(self, history: PriceHistory, window: float,
+                 min_listings: int):
+        self.history = history
+        self.window = window
+        self.min_listings = min_listings
+        self.logger = getLogger()
+        self.last_row = 0
+        self.postal_codes = np.empty(0, dtype=np.int32)
+        self.bedrooms = np.empty(0, dtype=np.int16)
+        self.price_per_sqm = np.empty(0, dtype=np.float64)
+        self.first_seen = np.empty(0, dtype=np.float64)
+        # group key -> (number of listings, percentiles)
+        self.stats: Dict[int, Tuple[int, np.ndarray]] = {}
+        self.computed = 0.0
+
+    def close(self) -> None:
+        self.history.close()
+
+    def refresh(self) -> None:
+        """ Load the listings recorded since last time and update stats """
+        with metrics.timed("analytics_seconds"):
+            rows = self.history.listings(self.last_row)
+            if len(rows) > 0:
+                self.last_row = rows[-1][0]
+                self.__append__(rows)
+            elif time.time() < self.computed + RECOMPUTE:
+                return
+            self.__compute__()
+
+    def __append__(self, rows) -> None:
+        postal_codes = []
+        kept = []
+        for row in rows:
+            found = postal_codes(row[4])
+            if len(found) > 0:
+                postal_codes.append(int(found[0]))
+                kept.append(row)
+        if len(kept) == 0:
+            return
+        _, price, area, bedrooms, _, first_seen = zip(*kept)
+        bedrooms = np.array([-1 if b is None else b for b in bedrooms])
+        self.postal_codes = np.concatenate(
+            [self.postal_codes, np.array(postal_codes, dtype=np.int32)])
+        self.bedrooms = np.concatenate(
+            [self.bedrooms,
+             np.clip(bedrooms, -1, ALL_BEDROOMS - 1).astype(np.int16)])
+        self.price_per_sqm = np.concatenate(
+            [self.price_per_sqm,
+             np.array(price, dtype=np.float64) / np.array(area)])
+        self.first_seen = np.concatenate(
+            [self.first_seen, np.array(first_seen, dtype=np.float64)])
+
+    def __compute__(self) -> None:
+        recent = self.first_seen >= time.time() - self.window
+        postal_codes = self.postal_codes[recent].astype(np.int64)
+        bedrooms = self.bedrooms[recent]
+        values = self.price_per_sqm[recent]
+        known = bedrooms >= 0
+        keys = np.concatenate([
+            group_key(postal_codes[known], bedrooms[known]),
+            group_key(postal_codes, ALL_BEDROOMS)])
+        values = np.concatenate([values[known], values])
+        self.stats = self.__percentiles__(keys, values)
+        self.computed = time.time()
+        metrics.set("analytics_listings", len(postal_codes))
+
+    @staticmethod
+    def __percentiles__(keys: np.ndarray, values: np.ndarray
+                        ) -> Dict[int, Tuple[int, np.ndarray]]:
+        """
+        Percentiles of the values of every group in one go: values are
+        sorted by group then value, and the percentiles of each group
+        interpolated between its closest ranks, as np.percentile does.
+        """
+        if len(keys) == 0:
+            return {}
+        order = np.lexsort((values, keys))
+        keys = keys[order]
+        values = values[order]
+        groups, starts, counts = np.unique(keys, return_index=True,
+                                           return_counts=True)
+        ranks = starts[:, None] +\
+            (counts[:, None] - 1) * (PERCENTILES / 100)
+        low = np.floor(ranks).astype(np.int64)
+        high = np.ceil(ranks).astype(np.int64)
+        percentiles = values[low] + (values[high] - values[low]) *\
+            (ranks - low)
+        return {int(group): (int(count), percentile)
+                for group, count, percentile
+                in zip(groups, counts, percentiles)}
+
+    def compare(self, details: CompleteDetails) -> Optional[str]:
+        """
+        How the price per m² of the property compares with the median of
+        its area, if enough listings of the area are known.
+        """
+        if not isinstance(details, CompleteDetails) or\
+                details.price_per_sqm <= 0:
+            return None
+        found = postal_codes(details.address)
+        if len(found) == 0:
+            return None
+        postal_code = int(found[0])
+        groups = [(ALL_BEDROOMS, f"{postal_code}")]
+        if details.bedrooms is not None:
+            bedrooms = min(details.bedrooms, ALL_BEDROOMS - 1)
+            groups.insert(0, (bedrooms, f"{details.bedrooms} bedrooms "
+                                        f"in {postal_code}"))
+        for bedrooms, label in groups:
+            count, percentiles = self.stats.get(
+                group_key(postal_code, bedrooms), (0, None))
+            if count < self.min_listings:
+                continue
+            median = percentiles[1]
+            difference = details.price_per_sqm / median - 1
+            side = "below" if difference < 0 else "above"
+            return (f"{abs(difference):.0%} {side} area median "
+                    f"({median:.0f}€/m² for {label}, {count} listings)")
+        return None
+
+
+def open_market(conf: ConfigFactory) -> Optional[MarketStats]:
+    """
+    Market statistics as configured in 'general.analytics',
+    out of the price history which must be kept too.
+    """
+    if not conf.get("general.analytics.enabled", False):
+        return None
+    history = open_history(conf)
+    if history is None:
+        getLogger().warn("Market analytics need the price history, "
+                         "enable 'general.history' to get them")
+        return None
+    return MarketStats(history,
+                       conf.get("general.analytics.window", 180) * 86400,
+                       conf.get("general.analytics.min_listings", 5))
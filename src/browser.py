@@ -1,12 +1,241 @@
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
+from selenium.common.exceptions import WebDriverException
 from pyhocon import ConfigFactory
+from contextlib import contextmanager
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import quote
+import json
+import threading
+from logging import getLogger
+
+from metrics import metrics
+
+
+# firefox preferences turning off the loading of each kind of resource
+BLOCKING_PREFERENCES = {
+    "images": {"permissions.default.image": 2},
+    "media": {"media.autoplay.default": 5,
+              "media.autoplay.blocking_policy": 2,
+              "media.play-stand-alone": False,
+              "media.peerconnection.enabled": False},
+    "fonts": {"gfx.downloadable_fonts.enabled": False,
+              "browser.display.use_document_fonts": 0},
+    "css": {"permissions.default.stylesheet": 2},
+}
+# nothing listens on the discard port: denied requests fail right away
+DENIED_PROXY = "PROXY 127.0.0.1:9"
+
+
+def denylist_pac(domains: List[str]) -> str:
+    """
+    Proxy auto-config script sending the requests to the given domains
+    (and their sub domains) to a dead proxy, all others going direct.
+    """
+    return ("function FindProxyForURL(url, host) {"
+            f" var denied = {json.dumps(domains)};"
+            " for (var i = 0; i < denied.length; i++) {"
+            "  if (host == denied[i] || dnsDomainIs(host, '.' + denied[i])) {"
+            f"   return '{DENIED_PROXY}';"
+            "  }"
+            " }"
+            " return 'DIRECT';"
+            "}")
+
+
+def lean_preferences(conf: ConfigFactory) -> Dict[str, object]:
+    """
+    Firefox preferences of the lean profile: resources listed in
+    'browser.block' are not loaded, nor anything from the domains of
+    'browser.denylist'.
+    """
+    preferences = {"privacy.trackingprotection.enabled": True}
+    for resource in conf.get("browser.block", []):
+        preferences.update(BLOCKING_PREFERENCES[resource])
+    denylist = conf.get("browser.denylist", [])
+    if len(denylist) > 0:
+        pac = denylist_pac(list(denylist))
+        preferences.update({"network.proxy.type": 2,
+                            "network.proxy.autoconfig_url":
+                            f"data:text/javascript,{quote(pac)}"})
+    return preferences
 
 
 def launch_selenium(conf: ConfigFactory) -> webdriver:
+    """
+    Start a headless firefox, with the lean profile if 'browser.lean' is
+    set. The 'browser.page_load' strategy tells when a page counts as
+    loaded: "normal" once all of its resources are, "eager" as soon as
+    its html is parsed.
+    """
     options = Options()
     options.headless = True
+    if conf.get("browser.lean", False):
+        for name, value in lean_preferences(conf).items():
+            options.set_preference(name, value)
+    options.page_load_strategy = conf.get("browser.page_load", "normal")
     driver = webdriver.Firefox(options=options,
                                executable_path=conf["gecko_path"])
     driver.implicitly_wait(5)
     return driver
+
+
+class PooledBrowser():
+    """
+    Thin wrapper around a selenium browser handed out by a BrowserPool.
+    It behaves like the wrapped webdriver but keeps track of how many
+    pages were loaded so that the pool can recycle worn out browsers.
+    """
+
+    def __init__(self, driver: webdriver):
+        self.driver = driver
+        self.pages = 0
+
+    def get(self, url: str) -> None:
+        self.pages += 1
+        self.driver.get(url)
+
+    def __getattr__(self, attr):
+        return getattr(self.driver, attr)
+
+
+class BrowserPool():
+    """
+    Pool of headless browsers shared by searchers and detail finders.
+
+    Browsers are launched lazily (up to 'pool_size' of them), leased out
+    with 'lease()' and handed back once the caller is done with them.
+    A browser is restarted after having served 'max_pages' pages, when it
+    fails its health check or when it crashed while being leased.
+    """
+
+    def __init__(self, conf: ConfigFactory):
+        self.conf = conf
+        self.size = conf.get("browser.pool_size", 1)
+        self.max_pages = conf.get("browser.max_pages", 200)
+        self.logger = getLogger()
+        self.idle: List[PooledBrowser] = []
+        self.launched = 0
+        self.available = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __launch__(self) -> PooledBrowser:
+        self.logger.debug("Launching a new pooled browser")
+        metrics.inc("browser_launches_total")
+        return PooledBrowser(launch_selenium(self.conf))
+
+    def __discard__(self, browser: PooledBrowser) -> None:
+        try:
+            browser.driver.quit()
+        except WebDriverException:
+            # browser probably already dead, nothing left to clean
+            pass
+
+    def __healthy__(self, browser: PooledBrowser) -> bool:
+        if browser.pages >= self.max_pages:
+            self.logger.debug(f"Recycling browser after {browser.pages} "
+                              "pages")
+            return False
+        try:
+            browser.driver.current_url
+        except WebDriverException:
+            self.logger.warn("Pooled browser failed its health check")
+            return False
+        return True
+
+    def __acquire__(self) -> PooledBrowser:
+        with self.available:
+            while True:
+                if len(self.idle) > 0:
+                    browser = self.idle.pop()
+                    break
+                if self.launched < self.size:
+                    self.launched += 1
+                    browser = None
+                    break
+                self.available.wait()
+        if browser is not None and self.__healthy__(browser):
+            return browser
+        if browser is not None:
+            metrics.inc("browser_restarts_total", reason="recycled")
+            self.__discard__(browser)
+        try:
+            return self.__launch__()
+        except Exception:
+            with self.available:
+                self.launched -= 1
+                self.available.notify()
+            raise
+
+    def __release__(self, browser: PooledBrowser, failed: bool) -> None:
+        # a failure might just be a missing element on the page,
+        # only throw the browser away if it is not responsive anymore
+        crashed = failed and not self.__healthy__(browser)
+        if crashed:
+            self.logger.warn("Discarding pooled browser after a failure")
+            metrics.inc("browser_restarts_total", reason="crashed")
+            self.__discard__(browser)
+        with self.available:
+            if crashed:
+                self.launched -= 1
+            else:
+                self.idle.append(browser)
+            self.available.notify()
+
+    @contextmanager
+    def lease(self):
+        """
+        Lease a browser from the pool for the duration of the with block.
+        """
+        browser = self.__acquire__()
+        failed = False
+        try:
+            yield browser
+        except WebDriverException:
+            failed = True
+            raise
+        finally:
+            self.__release__(browser, failed)
+
+    def close(self) -> None:
+        with self.available:
+            idle, self.idle = self.idle, []
+            self.launched -= len(idle)
+        for browser in idle:
+            self.__discard__(browser)
+
+
+_shared_pool: Optional[BrowserPool] = None
+_shared_users = 0
+_shared_lock = threading.Lock()
+
+
+def acquire_pool(conf: ConfigFactory) -> BrowserPool:
+    """
+    Get hold of the browser pool shared by the whole process,
+    creating it on first use.
+    Every call must be matched by a call to 'release_pool'.
+    """
+    global _shared_pool, _shared_users
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = BrowserPool(conf)
+        _shared_users += 1
+        return _shared_pool
+
+
+def release_pool() -> None:
+    """ Release the shared pool, closing it once nobody uses it anymore """
+    global _shared_pool, _shared_users
+    with _shared_lock:
+        _shared_users -= 1
+        if _shared_users == 0 and _shared_pool is not None:
+            _shared_pool.close()
+            _shared_pool = None
@@ -0,0 +1,122 @@
+from pyhocon import ConfigFactory
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+import hashlib
+import pickle
+import sqlite3
+import time
+from logging import getLogger
+
+# fields for which a change is worth reporting
+WATCHED_FIELDS = ["price", "area"]
+
+
+def load(data: bytes) -> Optional[Any]:
+    """ Unpickle cached details, None if cached by an older version """
+    try:
+        return pickle.loads(data)
+    except (AttributeError, TypeError, pickle.UnpicklingError):
+        return None
+
+
+def content_hash(details: Any) -> str:
+    content = "|".join([str(details.price), str(details.address),
+                        str(details.bedrooms), str(details.area)])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class DetailCache():
+    """
+    Persistent cache of the parsed details of properties, keyed by site
+    and id. Entries are fresh for 'ttl' seconds and the least recently used
+    ones are evicted once there are more than 'max_entries' of them.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.logger = getLogger()
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS details ("
+                            " site TEXT NOT NULL,"
+                            " id TEXT NOT NULL,"
+                            " details BLOB NOT NULL,"
+                            " hash TEXT NOT NULL,"
+                            " fetched REAL NOT NULL,"
+                            " accessed REAL NOT NULL,"
+                            " PRIMARY KEY (site, id))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS details_accessed "
+                            "ON details (accessed)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def get(self, site: str, prop: str) -> Optional[Any]:
+        """ Cached details of the property, if fresh enough """
+        row = self.db.execute("SELECT details, fetched FROM details "
+                              "WHERE site = ? AND id = ?",
+                              [site, prop]).fetchone()
+        if row is None or row[1] + self.ttl < time.time():
+            return None
+        details = load(row[0])
+        if details is None:
+            return None
+        with self.db:
+            self.db.execute("UPDATE details SET accessed = ? "
+                            "WHERE site = ? AND id = ?",
+                            [time.time(), site, prop])
+        return details
+
+    def put(self, site: str, prop: str,
+            details: Any) -> Dict[str, Tuple]:
+        """
+        Cache freshly fetched details, returning the watched fields
+        that changed since the previous fetch as field: (old, new).
+        """
+        new_hash = content_hash(details)
+        row = self.db.execute("SELECT details, hash FROM details "
+                              "WHERE site = ? AND id = ?",
+                              [site, prop]).fetchone()
+        changes = {}
+        previous = None if row is None else load(row[0])
+        if previous is not None and row[1] != new_hash:
+            changes = {field: (getattr(previous, field),
+                               getattr(details, field))
+                       for field in WATCHED_FIELDS
+                       if getattr(previous, field) != getattr(details, field)}
+        now = time.time()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO details "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            [site, prop, pickle.dumps(details), new_hash,
+                             now, now])
+            self.__evict__()
+        return changes
+
+    def __evict__(self) -> None:
+        count = self.db.execute("SELECT COUNT(*) FROM details").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("DELETE FROM details WHERE rowid IN ("
+                            " SELECT rowid FROM details"
+                            " ORDER BY accessed LIMIT ?)",
+                            [count - self.max_entries])
+
+
+def open_cache(conf: ConfigFactory) -> DetailCache:
+    """ Open the detail cache as configured in 'general.detail_cache' """
+    shelve_dir = conf["general.shelve_dir"]
+    return DetailCache(
+        conf.get("general.detail_cache.path",
+                 f"{shelve_dir}details.sqlite"),
+        conf.get("general.detail_cache.ttl", 24) * 3600,
+        conf.get("general.detail_cache.max_entries", 10000))
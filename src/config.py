@@ -0,0 +1,34 @@
+from pyhocon import ConfigFactory
+from pyhocon import ConfigTree
+import os
+import pickle
+from logging import getLogger
+
+
+def load_conf(path: str) -> ConfigTree:
+    """
+    Parse and resolve the configuration file at path, reusing the
+    resolved configuration cached in '<path>.cache' as long as the file
+    was not modified since. Files it includes are not watched.
+    """
+    cache = f"{path}.cache"
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(cache, "rb") as cached:
+            cached_stamp, conf = pickle.load(cached)
+        if cached_stamp == stamp:
+            return conf
+    except (OSError, EOFError, ValueError, AttributeError, TypeError,
+            pickle.UnpicklingError):
+        # no cache yet or written by an older version
+        pass
+    conf = ConfigFactory.parse_file(path)
+    partial = f"{cache}.{os.getpid()}"
+    try:
+        with open(partial, "wb") as cached:
+            pickle.dump((stamp, conf), cached)
+        os.replace(partial, cache)
+    except OSError as error:
+        getLogger().warn(f"Could not cache the configuration: {error}")
+    return conf
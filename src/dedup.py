@@ -0,0 +1,179 @@
+from pyhocon import ConfigFactory
+from typing import FrozenSet
+from typing import List
+from typing import Optional
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+import math
+import re
+import sqlite3
+import time
+import unicodedata
+from logging import getLogger
+
+from details import CompleteDetails
+
+# words showing up in addresses without telling anything about them
+ADDRESS_NOISE = {"no", "exact", "address", "ask", "for", "the"}
+POSTAL_CODE = re.compile(r"\b[1-9][0-9]{3}\b")
+
+
+def normalize_address(address: str) -> str:
+    """ Lower case, accent and punctuation free version of an address """
+    address = unicodedata.normalize("NFKD", address or "")
+    address = address.encode("ascii", "ignore").decode("ascii").lower()
+    return re.sub(r"[^a-z0-9]+", " ", address).strip()
+
+
+def postal_codes(address: Optional[str]) -> List[str]:
+    """
+    Postal codes an address may be in, most likely first.
+    Street numbers come before the postal code and may have 4 digits too.
+    """
+    return POSTAL_CODE.findall(address or "")[::-1]
+
+
+def identity(url: str) -> str:
+    """ Url of a listing stripped of its tracking query parameters """
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}"
+
+
+@dataclass(frozen=True)
+class Fingerprint:
+    """ Normalized description of a property, whatever the website """
+    postal_code: Optional[str]
+    street: FrozenSet[str]
+    price: Optional[int]
+    area: Optional[int]
+    bedrooms: Optional[int]
+
+    @classmethod
+    def of(cls, details: CompleteDetails) -> "Fingerprint":
+        address = normalize_address(details.address)
+        candidates = postal_codes(address)
+        postal_code = candidates[0] if len(candidates) > 0 else None
+        street = frozenset([token for token in address.split(" ")
+                            if token not in ADDRESS_NOISE and
+                            token != postal_code])
+        return cls(postal_code, street, details.price,
+                   details.area, details.bedrooms)
+
+
+class DuplicateIndex():
+    """
+    Index of the properties already alerted on, used to spot the same
+    property listed on several websites.
+    Properties are blocked on (postal code, bedrooms, price bucket)
+    so that a lookup only compares the handful of properties sharing
+    a block instead of every property ever seen.
+    Only properties of other websites indexed less than 'window' seconds
+    ago are compared, and only if both their street and area are known.
+    """
+
+    def __init__(self, path: str, price_tolerance: float,
+                 area_tolerance: float, bucket: int, window: float):
+        self.price_tolerance = price_tolerance
+        self.area_tolerance = area_tolerance
+        self.bucket = bucket
+        self.window = window
+        self.logger = getLogger()
+        self.db = sqlite3.connect(path, timeout=30)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS fingerprints ("
+                            " identity TEXT PRIMARY KEY,"
+                            " url TEXT NOT NULL,"
+                            " postal_code TEXT NOT NULL,"
+                            " bedrooms INTEGER,"
+                            " price_bucket INTEGER NOT NULL,"
+                            " price INTEGER NOT NULL,"
+                            " area INTEGER,"
+                            " street TEXT NOT NULL,"
+                            " added REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS fingerprints_block "
+                            "ON fingerprints "
+                            "(postal_code, bedrooms, price_bucket)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    @staticmethod
+    def __indexable__(fingerprint: Fingerprint) -> bool:
+        return fingerprint.postal_code is not None and\
+            fingerprint.price is not None
+
+    def __close_to__(self, a: Optional[int], b: Optional[int],
+                     tolerance: float) -> bool:
+        if a is None or b is None:
+            # unknown on one side, nothing tells they are the same
+            return False
+        return abs(a - b) <= tolerance * max(a, b)
+
+    def __same_street__(self, a: FrozenSet[str], b: FrozenSet[str]) -> bool:
+        if len(a) == 0 or len(b) == 0:
+            # no exact address on one side, nothing to compare
+            return False
+        return len(a & b) / len(a | b) >= 0.5
+
+    def find(self, url: str, fingerprint: Fingerprint) -> Optional[str]:
+        """
+        Url of an already indexed property which is likely to be the
+        same as the one given, if any.
+        """
+        if not self.__indexable__(fingerprint):
+            return None
+        low = math.floor(fingerprint.price * (1 - self.price_tolerance)
+                         / self.bucket)
+        high = math.floor(fingerprint.price * (1 + self.price_tolerance)
+                          / self.bucket)
+        bedrooms = "bedrooms IS ?" if fingerprint.bedrooms is None\
+            else "bedrooms = ?"
+        candidates = self.db.execute(
+            "SELECT url, price, area, street FROM fingerprints "
+            f"WHERE postal_code = ? AND {bedrooms} "
+            "AND price_bucket BETWEEN ? AND ? AND added >= ?",
+            [fingerprint.postal_code, fingerprint.bedrooms, low, high,
+             time.time() - self.window])
+        site = urlsplit(url).netloc
+        for other_url, price, area, street in candidates:
+            # listings of a same website are told apart by their IDs
+            if urlsplit(other_url).netloc == site:
+                continue
+            if self.__close_to__(price, fingerprint.price,
+                                 self.price_tolerance) and\
+               self.__close_to__(area, fingerprint.area,
+                                 self.area_tolerance) and\
+               self.__same_street__(frozenset(street.split(" ")) - {""},
+                                    fingerprint.street):
+                return other_url
+        return None
+
+    def add(self, url: str, fingerprint: Fingerprint) -> None:
+        if not self.__indexable__(fingerprint):
+            return
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO fingerprints "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [identity(url), url, fingerprint.postal_code,
+                             fingerprint.bedrooms,
+                             fingerprint.price // self.bucket,
+                             fingerprint.price, fingerprint.area,
+                             " ".join(sorted(fingerprint.street)),
+                             time.time()])
+
+
+def open_index(conf: ConfigFactory) -> DuplicateIndex:
+    """ Open the duplicates index as configured in 'general.dedup' """
+    shelve_dir = conf["general.shelve_dir"]
+    return DuplicateIndex(
+        conf.get("general.seen_db", f"{shelve_dir}seen.sqlite"),
+        conf.get("general.dedup.price_tolerance", 0.02),
+        conf.get("general.dedup.area_tolerance", 0.05),
+        conf.get("general.dedup.price_bucket", 25000),
+        conf.get("general.dedup.window", 30) * 86400)
@@ -1,25 +1,44 @@
 from pyhocon import ConfigFactory
+from typing import Any
 from typing import Dict
+from typing import Optional
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
 from dataclasses import field
-from selenium import webdriver
 from selenium.common.exceptions import NoSuchElementException
 
 from logging import getLogger
 
-from browser import launch_selenium
+from cache import open_cache
+from extract import RuleSet
+from fetch import FetchEngine
+from fetch import Page
+from fetch import open_engine
+from health import circuit
+from metrics import metrics
 
 
-@dataclass
+@dataclass(slots=True)
 class Details:
     url: str
+    # urls of the same property listed on other websites, a tuple
+    # rather than a list to share the empty one between all properties
+    other_urls: Tuple[str, ...] = field(default=(), init=False,
+                                        repr=False, compare=False)
+
+    def __urls_str__(self) -> str:
+        if len(self.other_urls) == 0:
+            return self.url
+        return "\n".join([self.url, "Also listed on:", *self.other_urls])
 
     def __str__(self):
-        return self.url
+        return self.__urls_str__()
 
 
-@dataclass
+@dataclass(slots=True)
 class CompleteDetails(Details):
     """Class representing details of an immo property."""
     price: int
@@ -57,7 +76,7 @@ class CompleteDetails(Details):
                           f"Area: {self.__area_str__()}",
                           f"Price per m²: {self.__price_per_sqm_str__()}",
                           f"Bedrooms: {self.__bedrooms_str__()}",
-                          self.url])
+                          self.__urls_str__()])
 
 
 class DetailFinder():
@@ -65,41 +84,156 @@ class DetailFinder():
         self.conf = conf
         self.logger = getLogger()
 
-    def findFor(self, props: Dict[str, str]) -> Dict[str, Details]:
+    def findFor(self, props: Dict[str, str], refresh: bool = False,
+                engine: Optional[FetchEngine] = None) -> Dict[str, Details]:
+        """
+        With 'refresh', cached details are fetched again.
+        Pages are loaded with the given engine if any, e.g. the one the
+        searcher of the site already has open, or with one of their own.
+        """
         return {k: Details(v) for k, v in props.items()}
 
 
+_site_limits: Dict[str, threading.Semaphore] = {}
+_site_limits_lock = threading.Lock()
+
+
+def site_limit(site: str, limit: int) -> threading.Semaphore:
+    """
+    Semaphore shared by every detail finder of the given site,
+    capping the number of its pages being loaded at the same time.
+    """
+    with _site_limits_lock:
+        if site not in _site_limits:
+            _site_limits[site] = threading.BoundedSemaphore(limit)
+        return _site_limits[site]
+
+
 class SeleniumDetailFinder(DetailFinder, metaclass=ABCMeta):
+    @property
     @abstractmethod
-    def __findDetail__(self, url: str, browser: webdriver) -> Details:
+    def site(self):
         pass
 
-    def findFor(self, props: Dict[str, str]) -> Dict[str, Details]:
+    @property
+    @abstractmethod
+    def rules(self) -> RuleSet:
+        pass
+
+    def __findDetail__(self, url: str, page: Page) -> Details:
+        # a single lookup to make sure the details are rendered,
+        # everything else is read out of one snapshot of the page
+        if len(page.find_elements_by_xpath(self.rules.container)) == 0:
+            self.logger.warn(
+                f"Can't find {self.site} formatted details for {url=}")
+            return Details(url)
+        with metrics.timed("parse_seconds", site=self.site):
+            fields = self.rules.extract(page.source)
+        if fields is None:
+            self.logger.warn(
+                f"Can't find {self.site} formatted details for {url=}")
+            return Details(url)
+        self.logger.debug(f"Found some details for {url=}")
+        return self.__details__(url, fields)
+
+    def __details__(self, url: str, fields: Dict[str, Any]) -> Details:
+        """ Build the details of a property out of its extracted fields """
+        return CompleteDetails(url, **fields)
+
+    def findFor(self, props: Dict[str, str], refresh: bool = False,
+                engine: Optional[FetchEngine] = None) -> Dict[str, Details]:
         if len(props) == 0:
             return props
-        browser = launch_selenium(self.conf["general"])
-        detailed = {}
-        for prop, url in props.items():
-            try:
-                detailed[prop] = self.__findDetail__(url, browser)
-            except (NoSuchElementException, IndexError, ValueError):
-                # These error types correspond to:
-                # NoSuchElementException:
-                #    Selenium not finding the expected element on the page
-                # IndexError:
-                #    The size of a text after splitting is too small
-                #    e.g. not all element expected in the same text zone are
-                #    present
-                # ValueError:
-                #    Text zone that was expected to only contain a number ha
-                #    a different format than is handled
-                #    e.g. instead of just the price, we have a
-                #    'Starting price xxxx$' format
-                self.logger.error("Unexcpected error encountered "
-                                  f"while looking for details of {prop} "
-                                  f"in page {url}")
-                self.logger.exception("Exception: ")
-                # Safely recover by using a less complete Details
-                detailed[prop] = Details[url]
-        browser.quit()
+        with open_cache(self.conf) as cache:
+            detailed = {prop: None if refresh else cache.get(self.site, prop)
+                        for prop in props}
+            missing = {prop: url for prop, url in props.items()
+                       if detailed[prop] is None}
+            self.logger.debug(f"{len(props) - len(missing)} {self.site} "
+                              "details found in cache")
+            if len(missing) == 0:
+                return detailed
+            if engine is not None:
+                fetched = self.__findAll__(missing, engine)
+            else:
+                # detail pages are fetched the same way as the search results
+                engine = open_engine(self.conf, self.site)
+                try:
+                    fetched = self.__findAll__(missing, engine)
+                finally:
+                    engine.close()
+            for prop, details in fetched.items():
+                detailed[prop] = details
+                if not isinstance(details, CompleteDetails):
+                    # do not cache the fallback on incomplete details
+                    continue
+                changes = cache.put(self.site, prop, details)
+                for name, (old, new) in changes.items():
+                    self.logger.info(f"The {name} of {self.site} property "
+                                     f"{prop} changed from {old} to {new}")
         return detailed
+
+    def __findAll__(self, props: Dict[str, str],
+                    engine: FetchEngine) -> Dict[str, Details]:
+        """
+        Fan the lookups out over up to 'general.details.workers' threads,
+        with never more than 'general.details.per_site' pages of the same
+        site being loaded at once across the whole bot.
+        Once the detail pages of the site keep failing, the remaining
+        properties fall back on less complete details right away.
+        """
+        workers = min(self.conf.get("general.details.workers", 1),
+                      len(props))
+        limit = site_limit(self.site,
+                           self.conf.get("general.details.per_site", 1))
+
+        breaker = circuit(self.conf, self.site, "detail")
+
+        def find(prop: str, url: str) -> Details:
+            if not breaker.allow():
+                return Details(url)
+            with limit:
+                details = self.__findOne__(prop, url, engine)
+            if isinstance(details, CompleteDetails):
+                breaker.success()
+            else:
+                breaker.failure()
+            return details
+        if workers <= 1:
+            return {prop: find(prop, url) for prop, url in props.items()}
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix=self.site) as executor:
+            futures = {prop: executor.submit(find, prop, url)
+                       for prop, url in props.items()}
+            # keep the order of the given properties
+            return {prop: future.result() for prop, future in futures.items()}
+
+    def __findOne__(self, prop: str, url: str,
+                    engine: FetchEngine) -> Details:
+        try:
+            with engine.open(url) as page:
+                return self.__findDetail__(url, page)
+        except (NoSuchElementException, IndexError, ValueError):
+            # These error types correspond to:
+            # NoSuchElementException:
+            #    Selenium not finding the expected element on the page
+            # IndexError:
+            #    The size of a text after splitting is too small
+            #    e.g. not all element expected in the same text zone are
+            #    present
+            # ValueError:
+            #    Text zone that was expected to only contain a number ha
+            #    a different format than is handled
+            #    e.g. instead of just the price, we have a
+            #    'Starting price xxxx$' format
+            self.logger.error("Unexcpected error encountered "
+                              f"while looking for details of {prop} "
+                              f"in page {url}")
+            self.logger.exception("Exception: ")
+            # Safely recover by using a less complete Details
+            return Details(url)
+        except Exception:
+            # e.g. the browser or the website failing
+            self.logger.exception(f"Failed loading details of {prop} "
+                                  f"in page {url}")
+            return Details(url)
@@ -0,0 +1,68 @@
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from dataclasses import dataclass
+from selenium.common.exceptions import NoSuchElementException
+from lxml import html
+
+from fetch import compiled
+from fetch import rendered_lines
+
+
+def lines(element) -> List[str]:
+    """ Non empty lines of text of an element, as a browser renders them """
+    return rendered_lines(element)
+
+
+def text(element) -> str:
+    return "\n".join(lines(element))
+
+
+@dataclass
+class Rule:
+    """
+    How to extract one field out of a page:
+    the first element found at 'xpath' (relative to the rule set container)
+    is read with 'read' and the result turned into the field's value
+    with 'parse'.
+    A missing optional element gives 'default' instead of an error.
+    """
+    field: str
+    xpath: str
+    parse: Callable[[Any], Any] = str.strip
+    read: Callable[[Any], Any] = text
+    required: bool = True
+    default: Any = None
+
+
+@dataclass
+class RuleSet:
+    """
+    All the rules to extract the details of a property out of a page,
+    evaluated in one go against a snapshot of the page source.
+    """
+    container: str
+    rules: List[Rule]
+
+    def extract(self, source: str) -> Optional[Dict[str, Any]]:
+        """
+        Extract every field out of the page source.
+        Returns None if the page does not hold the expected container.
+        """
+        containers = compiled(self.container)(html.fromstring(source))
+        if len(containers) == 0:
+            return None
+        container = containers[0]
+        fields = {}
+        for rule in self.rules:
+            results = compiled(rule.xpath)(container)
+            if len(results) > 0:
+                fields[rule.field] = rule.parse(rule.read(results[0]))
+            elif rule.required:
+                raise NoSuchElementException(
+                    f"No element found for {rule.field} at {rule.xpath=}")
+            else:
+                fields[rule.field] = rule.default
+        return fields
@@ -0,0 +1,312 @@
+from abc import ABC, abstractmethod
+from pyhocon import ConfigFactory
+from contextlib import contextmanager
+from typing import Dict
+from typing import List
+from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import TimeoutException
+from lxml import etree
+from lxml import html
+import re
+from logging import getLogger
+
+from metrics import metrics
+
+
+class Page(ABC):
+    """
+    A loaded page, offering the subset of the selenium API used by searchers
+    whatever the way the page was actually fetched.
+    """
+    @property
+    @abstractmethod
+    def source(self) -> str:
+        pass
+
+    @abstractmethod
+    def find_elements_by_xpath(self, xpath: str) -> List:
+        pass
+
+    @abstractmethod
+    def strings(self, xpath: str) -> List[str]:
+        """
+        Text of every node at the given xpath, attributes included,
+        read all at once rather than element by element.
+        """
+        pass
+
+    def find_element_by_xpath(self, xpath: str):
+        results = self.find_elements_by_xpath(xpath)
+        if len(results) == 0:
+            raise NoSuchElementException(f"No element found for {xpath=}")
+        return results[0]
+
+    def wait_for(self, xpath: str, timeout: float):
+        """ Wait for the element at the given xpath to be present """
+        return self.find_element_by_xpath(xpath)
+
+    def stop(self) -> None:
+        """ Stop loading anything else on the page """
+        pass
+
+
+class FetchEngine(ABC):
+    """
+    Way to fetch and read the pages of a website.
+    Engines are closed once the searcher using them is done.
+    """
+    def __init__(self, conf: ConfigFactory, site: str):
+        self.conf = conf
+        self.site = site
+        self.logger = getLogger()
+
+    @abstractmethod
+    def open(self, url: str):
+        """ Context manager loading the page at url and yielding a Page """
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+STRINGS_SCRIPT = """
+var nodes = document.evaluate(arguments[0], document, null,
+                              XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+var strings = [];
+for (var i = 0; i < nodes.snapshotLength; i++) {
+    strings.push(nodes.snapshotItem(i).textContent);
+}
+return strings;
+"""
+
+
+class SeleniumPage(Page):
+    def __init__(self, browser):
+        self.browser = browser
+
+    @property
+    def source(self) -> str:
+        return self.browser.page_source
+
+    def find_elements_by_xpath(self, xpath: str) -> List:
+        return self.browser.find_elements_by_xpath(xpath)
+
+    def find_element_by_xpath(self, xpath: str):
+        return self.browser.find_element_by_xpath(xpath)
+
+    def strings(self, xpath: str) -> List[str]:
+        # a single round trip to the browser
+        return self.browser.execute_script(STRINGS_SCRIPT, xpath)
+
+    def wait_for(self, xpath: str, timeout: float):
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait as wait
+        return wait(self.browser, timeout).until(
+            EC.presence_of_element_located((By.XPATH, xpath)))
+
+    def stop(self) -> None:
+        # JavaScript Executor to stop page load
+        self.browser.execute_script("window.stop();")
+
+
+class SeleniumEngine(FetchEngine):
+    """
+    Engine driving a headless browser leased from the shared pool.
+    Selenium's webdriver is only imported once such an engine is used.
+    """
+    def __init__(self, conf: ConfigFactory, site: str):
+        super().__init__(conf, site)
+        from browser import acquire_pool
+        self.pool = acquire_pool(conf["general"])
+
+    @contextmanager
+    def open(self, url: str):
+        with self.pool.lease() as browser:
+            with metrics.timed("page_load_seconds", site=self.site):
+                browser.get(url)
+            # time spent by the caller looking up elements on the page
+            with metrics.timed("lookup_seconds", site=self.site):
+                yield SeleniumPage(browser)
+
+    def close(self) -> None:
+        from browser import release_pool
+        release_pool()
+
+
+_compiled_xpaths: Dict[str, etree.XPath] = {}
+
+
+def compiled(xpath: str) -> etree.XPath:
+    """ Compile xpath expressions only once """
+    if xpath not in _compiled_xpaths:
+        _compiled_xpaths[xpath] = etree.XPath(xpath)
+    return _compiled_xpaths[xpath]
+
+
+HTML_SPACES = re.compile(r"[ \t\r\n\f]+")
+# elements a browser renders on their own lines
+BLOCK_TAGS = {"address", "article", "br", "dd", "div", "dl", "dt",
+              "footer", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr",
+              "li", "main", "nav", "ol", "p", "section", "table", "td",
+              "th", "tr", "ul"}
+
+
+# elements whose content is never shown as text
+HIDDEN_TAGS = {"head", "noscript", "script", "style", "template", "title"}
+HIDDEN_STYLE = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden")
+
+
+def rendered(node) -> bool:
+    """
+    Whether the text of the node would be shown by a browser, as far as
+    the html alone tells: stylesheets are not looked at.
+    """
+    if not isinstance(node.tag, str):
+        # comments and processing instructions
+        return False
+    if node.tag in HIDDEN_TAGS or node.get("hidden") is not None:
+        return False
+    return HIDDEN_STYLE.search(node.get("style", "")) is None
+
+
+def rendered_lines(element) -> List[str]:
+    """
+    Non empty lines of text of an element, split the way a browser
+    would render them: inline elements stay on the same line.
+    """
+    chunks = []
+
+    def walk(node):
+        if not rendered(node):
+            # its text is not shown, what follows it is
+            if node is not element and node.tail:
+                chunks.append(node.tail)
+            return
+        block = isinstance(node.tag, str) and node.tag in BLOCK_TAGS
+        if block:
+            chunks.append("\n")
+        if isinstance(node.tag, str) and node.text:
+            chunks.append(node.text)
+        for child in node:
+            walk(child)
+        if block:
+            chunks.append("\n")
+        if node is not element and node.tail:
+            chunks.append(node.tail)
+    walk(element)
+    # line breaks in the html source are just white space to a browser,
+    # only block elements start new lines
+    # (only ascii white space, non breaking spaces are kept as browsers do)
+    chunks = [chunk if chunk == "\n" else HTML_SPACES.sub(" ", chunk)
+              for chunk in chunks]
+    lines = [HTML_SPACES.sub(" ", line).strip(" ")
+             for line in " ".join(chunks).split("\n")]
+    return [line for line in lines if line]
+
+
+class HttpElement():
+    """ lxml element mimicking the parts of selenium's WebElement we use """
+    def __init__(self, element):
+        self.element = element
+
+    @property
+    def text(self) -> str:
+        return "\n".join(rendered_lines(self.element))
+
+    def get_attribute(self, name: str) -> str:
+        if name == "innerHTML":
+            inner = self.element.text or ""
+            return inner + "".join([html.tostring(child, encoding="unicode")
+                                    for child in self.element])
+        return self.element.get(name)
+
+    def find_elements_by_xpath(self, xpath: str) -> List["HttpElement"]:
+        return [HttpElement(result)
+                for result in compiled(xpath)(self.element)]
+
+    def find_element_by_xpath(self, xpath: str) -> "HttpElement":
+        results = self.find_elements_by_xpath(xpath)
+        if len(results) == 0:
+            raise NoSuchElementException(f"No element found for {xpath=}")
+        return results[0]
+
+    def find_element_by_tag_name(self, tag: str) -> "HttpElement":
+        return self.find_element_by_xpath(f".//{tag}")
+
+
+class HttpPage(Page):
+    def __init__(self, content: bytes, url: str):
+        self.content = content
+        self.tree = html.fromstring(content, base_url=url)
+        # selenium gives absolute links, do the same
+        self.tree.make_links_absolute(url)
+
+    @property
+    def source(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def find_elements_by_xpath(self, xpath: str) -> List[HttpElement]:
+        return [HttpElement(result) for result in compiled(xpath)(self.tree)]
+
+    def strings(self, xpath: str) -> List[str]:
+        return [str(result) if isinstance(result, str)
+                else result.text_content()
+                for result in compiled(xpath)(self.tree)]
+
+    def wait_for(self, xpath: str, timeout: float):
+        try:
+            return self.find_element_by_xpath(xpath)
+        except NoSuchElementException:
+            # behave as selenium would when the element never shows up
+            raise TimeoutException(f"No element found for {xpath=}")
+
+
+class HttpEngine(FetchEngine):
+    """
+    Engine reading the raw html served by the website with a pooled
+    http client, for websites serving their listings without javascript.
+    """
+    def __init__(self, conf: ConfigFactory, site: str):
+        super().__init__(conf, site)
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.timeout = conf.get("general.http.timeout", 20)
+        pool_size = conf.get("general.http.pool_size", 10)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        user_agent = conf.get("general.http.user_agent", None)
+        if user_agent is not None:
+            self.session.headers["User-Agent"] = user_agent
+
+    @contextmanager
+    def open(self, url: str):
+        with metrics.timed("page_load_seconds", site=self.site):
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            page = HttpPage(response.content, response.url)
+        # time spent by the caller looking up elements on the page
+        with metrics.timed("lookup_seconds", site=self.site):
+            yield page
+
+    def close(self) -> None:
+        self.session.close()
+
+
+ENGINES = {"selenium": SeleniumEngine,
+           "http": HttpEngine}
+
+
+def open_engine(conf: ConfigFactory, site: str) -> FetchEngine:
+    """
+    Start the fetch engine configured for the given site
+    ('<site>.engine', selenium by default).
+    """
+    engine = conf.get(f"{site}.engine", "selenium")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown fetch {engine=} for {site}, "
+                         f"expected one of {list(ENGINES)}")
+    return ENGINES[engine](conf, site)
@@ -0,0 +1,98 @@
+from pyhocon import ConfigFactory
+from typing import Dict
+from typing import Tuple
+import threading
+import time
+from logging import getLogger
+
+from metrics import metrics
+
+
+class CircuitBreaker():
+    """
+    Health of one stage (search, detail) of a website.
+    After 'failures' consecutive failures the circuit opens and the stage
+    is skipped for 'backoff' seconds, after which a single probe is let
+    through: the circuit closes again if it succeeds, otherwise it stays
+    open twice as long, up to 'max_backoff' seconds.
+    """
+
+    def __init__(self, site: str, stage: str, failures: int,
+                 backoff: float, max_backoff: float):
+        self.site = site
+        self.stage = stage
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = getLogger()
+        self.lock = threading.Lock()
+        self.consecutive = 0
+        self.delay = backoff
+        self.reopen = 0.0
+        self.probing = False
+
+    @property
+    def open(self) -> bool:
+        return self.consecutive >= self.failures
+
+    def allow(self) -> bool:
+        """ Whether the stage should be attempted now """
+        with self.lock:
+            if not self.open:
+                return True
+            if self.probing or time.monotonic() < self.reopen:
+                metrics.inc("circuit_skipped_total", site=self.site,
+                            stage=self.stage)
+                return False
+            self.probing = True
+            self.logger.info(f"Probing {self.site} {self.stage} "
+                             "after failures")
+            return True
+
+    def success(self) -> None:
+        with self.lock:
+            if self.open:
+                self.logger.info(f"{self.site} {self.stage} is back, "
+                                 "closing its circuit")
+                metrics.set("circuit_open", 0, site=self.site,
+                            stage=self.stage)
+            self.consecutive = 0
+            self.delay = self.backoff
+            self.probing = False
+
+    def failure(self) -> None:
+        with self.lock:
+            metrics.inc("failures_total", site=self.site, stage=self.stage)
+            self.consecutive += 1
+            if not self.open:
+                return
+            if self.probing:
+                self.delay = min(self.max_backoff, self.delay * 2)
+                self.probing = False
+                self.logger.warn(f"{self.site} {self.stage} still failing, "
+                                 f"skipping it for {self.delay:.0f}s")
+            elif self.consecutive == self.failures:
+                self.logger.warn(f"{self.site} {self.stage} failed "
+                                 f"{self.consecutive} times in a row, "
+                                 f"skipping it for {self.delay:.0f}s")
+            metrics.set("circuit_open", 1, site=self.site, stage=self.stage)
+            self.reopen = time.monotonic() + self.delay
+
+
+_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit(conf: ConfigFactory, site: str, stage: str) -> CircuitBreaker:
+    """
+    Circuit breaker of the given stage of a website, shared by the whole
+    bot, as configured in 'general.circuit'.
+    """
+    with _breakers_lock:
+        if (site, stage) not in _breakers:
+            _breakers[(site, stage)] = CircuitBreaker(
+                site, stage,
+                conf.get("general.circuit.failures", 3),
+                conf.get("general.circuit.backoff", 5) * 60,
+                conf.get("general.circuit.max_backoff", 240) * 60)
+        return _breakers[(site, stage)]
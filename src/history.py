@@ -0,0 +1,151 @@
+from pyhocon import ConfigFactory
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+import sqlite3
+import threading
+import time
+from logging import getLogger
+
+from details import CompleteDetails
+
+# fields of the details whose history is kept
+HISTORY_FIELDS = ["price", "address", "bedrooms", "area"]
+
+
+class PriceHistory():
+    """
+    History of the details of every listing reported, kept as deltas:
+    the first snapshot of a listing records all of its fields and later
+    ones only the fields that changed.
+    Listings are re-checked every 'recheck' seconds for 'max_age' seconds
+    after first being seen, at most 'sample' of them per site and search.
+    """
+
+    def __init__(self, path: str, recheck: float, max_age: float,
+                 sample: int):
+        self.recheck = recheck
+        self.max_age = max_age
+        self.sample = sample
+        self.logger = getLogger()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            # latest known state of every listing
+            self.db.execute("CREATE TABLE IF NOT EXISTS listings ("
+                            " site TEXT NOT NULL,"
+                            " id TEXT NOT NULL,"
+                            " url TEXT NOT NULL,"
+                            " price INTEGER,"
+                            " address TEXT,"
+                            " bedrooms INTEGER,"
+                            " area INTEGER,"
+                            " first_seen REAL NOT NULL,"
+                            " checked REAL NOT NULL,"
+                            " PRIMARY KEY (site, id))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS listings_checked "
+                            "ON listings (site, checked)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS changes ("
+                            " site TEXT NOT NULL,"
+                            " id TEXT NOT NULL,"
+                            " time REAL NOT NULL,"
+                            " field TEXT NOT NULL,"
+                            " value)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS changes_listing "
+                            "ON changes (site, id, time)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def record(self, site: str, prop: str,
+               details: CompleteDetails) -> Dict[str, Tuple[Any, Any]]:
+        """
+        Record a snapshot of the details of a listing, returning the
+        fields that changed since the previous one as field: (old, new).
+        """
+        now = time.time()
+        values = [getattr(details, name) for name in HISTORY_FIELDS]
+        with self.lock, self.db:
+            row = self.db.execute("SELECT price, address, bedrooms, area "
+                                  "FROM listings WHERE site = ? AND id = ?",
+                                  [site, prop]).fetchone()
+            if row is None:
+                changes = {name: (None, value)
+                           for name, value in zip(HISTORY_FIELDS, values)}
+                self.db.execute("INSERT INTO listings VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [site, prop, details.url, *values, now, now])
+            else:
+                changes = {name: (old, new) for name, old, new
+                           in zip(HISTORY_FIELDS, row, values) if old != new}
+                self.db.execute("UPDATE listings SET url = ?, price = ?, "
+                                "address = ?, bedrooms = ?, area = ?, "
+                                "checked = ? WHERE site = ? AND id = ?",
+                                [details.url, *values, now, site, prop])
+            self.db.executemany("INSERT INTO changes VALUES (?, ?, ?, ?, ?)",
+                                [(site, prop, now, name, new)
+                                 for name, (_, new) in changes.items()])
+        return changes if row is not None else {}
+
+    def checked(self, site: str, props: Iterable[str]) -> None:
+        """ Mark listings as checked, even if they could not be """
+        with self.lock, self.db:
+            self.db.executemany("UPDATE listings SET checked = ? "
+                                "WHERE site = ? AND id = ?",
+                                [(time.time(), site, prop)
+                                 for prop in props])
+
+    def due(self, site: str) -> Dict[str, str]:
+        """ Sample of the listings due to be re-checked, as id: url """
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute("SELECT id, url FROM listings "
+                                   "WHERE site = ? AND checked <= ? "
+                                   "AND first_seen >= ? "
+                                   "ORDER BY checked LIMIT ?",
+                                   [site, now - self.recheck,
+                                    now - self.max_age, self.sample])
+            return {prop: url for prop, url in rows}
+
+    def listings(self, after: int = 0
+                 ) -> List[Tuple[int, int, int, int, str, float]]:
+        """
+        Listings with a known price and area recorded after the given row,
+        as (row, price, area, bedrooms, address, first_seen).
+        """
+        with self.lock:
+            return self.db.execute("SELECT rowid, price, area, bedrooms, "
+                                   "address, first_seen FROM listings "
+                                   "WHERE rowid > ? AND price > 0 "
+                                   "AND area > 0 ORDER BY rowid",
+                                   [after]).fetchall()
+
+    def history(self, site: str, prop: str) -> List[Tuple[float, str, Any]]:
+        """ Every recorded change of a listing as (time, field, value) """
+        with self.lock:
+            return self.db.execute("SELECT time, field, value FROM changes "
+                                   "WHERE site = ? AND id = ? ORDER BY time",
+                                   [site, prop]).fetchall()
+
+
+def open_history(conf: ConfigFactory) -> Optional[PriceHistory]:
+    """ Open the price history as configured in 'general.history' """
+    if not conf.get("general.history.enabled", False):
+        return None
+    shelve_dir = conf["general.shelve_dir"]
+    return PriceHistory(
+        conf.get("general.history.path", f"{shelve_dir}history.sqlite"),
+        conf.get("general.history.recheck", 24) * 3600,
+        conf.get("general.history.max_age", 60) * 86400,
+        conf.get("general.history.sample", 5))
@@ -1,23 +1,45 @@
-import telegram_send as ts
 from pyhocon import ConfigFactory
 from typing import Callable
-import schedule
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+import importlib
 import time
+from details import Details
 from search import Searcher
 from search import MultiSearcher
-from immoweb import immowebFactory
-from immovlan import immovlanFactory
-from realo import realoFactory
 from logging import getLogger
 from typing import List
 
+from config import load_conf
 from logging_utils import initLogging
+from metrics import metrics
+from metrics import start_export
+from notify import Notifier
+from subscribers import SubscriptionIndex
+from subscribers import load_subscriptions
+from subscribers import share_search
+
+
+# module and factory of the searcher of every website,
+# only imported when the website is searched
+SITES = {"immoweb": ("immoweb", "immowebFactory"),
+         "immovlan": ("immovlan", "immovlanFactory"),
+         "realo": ("realo", "realoFactory")}
+
+
+def siteFactory(site: str) -> Callable[[ConfigFactory], Searcher]:
+    if site not in SITES:
+        raise ValueError(f"Unknown {site=}, expected one of {list(SITES)}")
+    module, factory = SITES[site]
+    return getattr(importlib.import_module(module), factory)
 
 
 def allSearchersFactory(conf: ConfigFactory) -> Searcher:
-    return MultiSearcher(conf, [immowebFactory(conf),
-                                immovlanFactory(conf),
-                                realoFactory(conf)])
+    """ Searcher of every website listed in 'general.sites' """
+    return MultiSearcher(conf, [siteFactory(site)(conf) for site
+                                in conf.get("general.sites", list(SITES))],
+                         deduplicate=conf.get("general.dedup.enabled", True))
 
 
 class ImmoBot():
@@ -27,8 +49,20 @@ class ImmoBot():
         self.searchFactory = searchFactory
         self.conf = conf
         self.logger = getLogger()
+        # with several subscribers, one search is shared by all of them
+        self.subscriptions = SubscriptionIndex(load_subscriptions(conf))
+        if len(self.subscriptions) > 0:
+            share_search(conf, self.subscriptions.subscriptions)
+        # sends the messages in the background once started
+        self.notifier = None
+        # prices of the properties are compared with those of their area
+        self.market = None
+        if conf.get("general.analytics.enabled", False):
+            # numpy is only loaded when needed
+            from analytics import open_market
+            self.market = open_market(conf)
 
-    def send(self, messages: List[str]) -> None:
+    def send(self, messages: List[str], chat: Optional[str] = None) -> None:
         self.logger.info(
             "Found new property(ies) and sending them to log...")
         for message in messages:
@@ -36,46 +70,142 @@ class ImmoBot():
         self.logger.info("... property(ies) sent")
 
     def job(self, searcher: Searcher) -> None:
-        search_results = searcher.search_new()
-        if len(search_results) > 0:
-            messages = [f"New property found {k}\n{v!s}"
-                        for k, v in search_results.items()]
-            self.send(messages)
+        start = time.monotonic()
+        try:
+            self.__search__(searcher, start)
+        finally:
+            # progress of the new properties, committed once per search
+            searcher.checkpoint()
+        self.__record_cycle__(time.monotonic() - start)
+
+    def __search__(self, searcher: Searcher, start: float) -> None:
+        if self.market is not None:
+            # before searching, so that new properties are not compared
+            # with themselves
+            self.market.refresh()
+        # properties of earlier searches that never made it to the end
+        resumed = searcher.resume()
+        self.__alert__([(f"New property found {k}\n"
+                         f"{self.__describe__(v)}", v)
+                        for k, v in resumed.items()])
+        searcher.notified(resumed.keys())
+        if self.conf.get("general.pipeline.streaming", False):
+            # every new property is sent as soon as it is detailed
+            first = True
+            for k, v in searcher.search_stream():
+                self.__alert__([(f"New property found {k}\n"
+                                 f"{self.__describe__(v)}", v)])
+                searcher.notified([k])
+                if first:
+                    metrics.observe("first_alert_seconds",
+                                    time.monotonic() - start)
+                    first = False
+        else:
+            search_results = searcher.search_new()
+            self.__alert__([(f"New property found {k}\n"
+                             f"{self.__describe__(v)}", v)
+                            for k, v in search_results.items()])
+            searcher.notified(search_results.keys())
+        alerts = []
+        for k, (old, v) in searcher.price_drops().items():
+            alerts.append((f"Price drop of {1 - v.price / old:.0%} "
+                           f"({old}€ to {v.price}€) for {k}\n"
+                           f"{self.__describe__(v)}", v))
+        self.__alert__(alerts)
+
+    def __alert__(self, alerts: List[Tuple[str, Details]]) -> None:
+        for chat, messages in self.__route__(alerts).items():
+            if self.notifier is None:
+                with metrics.timed("send_seconds"):
+                    self.send(messages, chat)
+            else:
+                self.notifier.enqueue(messages, chat)
+
+    def __describe__(self, details: Details) -> str:
+        if self.market is None:
+            return str(details)
+        comparison = self.market.compare(details)
+        if comparison is None:
+            return str(details)
+        return f"{details!s}\nPrice per m² {comparison}"
+
+    def __route__(self, alerts: List[Tuple[str, Details]]
+                  ) -> Dict[Optional[str], List[str]]:
+        """
+        Messages about the given properties to send to each chat,
+        the default chat being None.
+        """
+        routed: Dict[Optional[str], List[str]] = {}
+        for message, v in alerts:
+            if len(self.subscriptions) == 0:
+                routed.setdefault(None, []).append(message)
+                continue
+            for sub in self.subscriptions.match(v):
+                routed.setdefault(sub.chat, []).append(message)
+        return routed
+
+    @property
+    def frequency(self) -> int:
+        """
+        Number of minutes between searches. When polling adaptively,
+        searches come at the shortest polling interval and only look
+        through the websites (or locations) due to be searched again.
+        """
+        if self.conf.get("general.polling.adaptive", False):
+            return self.conf.get("general.polling.min_interval", 5)
+        return self.conf["general.bot.frequency"]
+
+    def __record_cycle__(self, duration: float) -> None:
+        budget = self.frequency * 60
+        metrics.observe("cycle_seconds", duration)
+        metrics.set("cycle_budget_ratio", duration / budget)
+        if duration > budget:
+            metrics.inc("cycle_overruns_total")
+            self.logger.warn(f"Search cycle took {duration:.0f}s, "
+                             f"more than the {budget}s between searches")
+        jsonl = self.conf.get("general.metrics.jsonl", None)
+        if jsonl:
+            metrics.append_jsonl(jsonl)
 
     def start(self) -> None:
+        import schedule
         self.logger.info("Starting ImmoBot")
+        start_export(self.conf)
+        self.notifier = Notifier(self.conf, self.send)
+        self.notifier.start()
         with self.searchFactory(self.conf) as searcher:
             try:
-                schedule.every(self.conf["general.bot.frequency"])\
+                schedule.every(self.frequency)\
                         .minutes.do(self.job, searcher)
                 schedule.run_all()
                 while True:
                     schedule.run_pending()
-                    time.sleep(self.conf["general.bot.sleep"])
+                    # sleep until the next search is due
+                    time.sleep(min(self.conf["general.bot.sleep"],
+                                   max(1, schedule.idle_seconds())))
             except KeyboardInterrupt:
                 self.logger.info("ImmoBot closing down")
+            finally:
+                self.notifier.stop()
+                self.notifier = None
+                if self.market is not None:
+                    self.market.close()
 
 
 class ImmoBotTelegram(ImmoBot):
-    def send(self, messages: List[str]) -> None:
+    def send(self, messages: List[str], chat: Optional[str] = None) -> None:
+        """ 'chat' is the telegram-send configuration file to use """
         self.logger.info(
             "Found new property(ies) and sending them to telegram...")
-        if len(messages) < 10:
-            ts.send(messages=messages)
-        else:
-            messages_chunks = [messages[x:x + 10]
-                               for x in range(0, len(messages), 10)]
-            first = True
-            for chunk in messages_chunks:
-                if not first:
-                    time.sleep(5)
-                ts.send(messages=chunk)
-                first = False
+        # loaded on first use, it takes a while to import
+        import telegram_send as ts
+        # batching and pacing are left to the notifier
+        ts.send(messages=messages, conf=chat)
         self.logger.info("... property(ies) sent")
 
 
 if __name__ == '__main__':
-    conf = ConfigFactory.parse_file("configuration/template.conf")
+    conf = load_conf("configuration/template.conf")
     initLogging(conf)
-    bot = ImmoBot(conf, immowebFactory)
+    bot = ImmoBot(conf, siteFactory("immoweb"))
     bot.start()
@@ -1,6 +1,6 @@
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
 from pyhocon import ConfigFactory
+from typing import Any
+from typing import Dict
 from typing import Optional
 
 from logging_utils import initLogging
@@ -8,50 +8,43 @@ from details import DetailFinder
 from details import Details
 from details import CompleteDetails
 from details import SeleniumDetailFinder
+from extract import Rule
+from extract import RuleSet
 from search import Searcher
 
 
+def parse_price(price: str) -> int:
+    return int(price.replace("\u202f", "")[:-1].strip().split(' ')[-1])
+
+
+def parse_first_number(value: str) -> int:
+    return int(value.strip().split(" ")[0])
+
+
+IMMOVLAN_RULES = RuleSet(
+    container="//div[@id = 'property-details']",
+    rules=[Rule("street", ".//span[contains(@class, 'street-line')]",
+                required=False, default="No exact address"),
+           Rule("city", ".//span[contains(@class, 'city-line')]"),
+           Rule("price", ".//span[contains(@class, 'price-label')]",
+                parse_price),
+           Rule("bedrooms", ".//div[contains(@class, 'NrOfBedrooms')]"
+                            "//div[@class = 'ico-text']", int),
+           Rule("area", ".//div[contains(@class, 'LivableSurface')]"
+                        "//div[@class = 'ico-text']", parse_first_number,
+                required=False)])
+# TODO add agency name, PEB, garden size, bathrooms
+
+
 class ImmovlanDetailFinder(SeleniumDetailFinder):
-    def __findDetail__(self, url: str, browser: webdriver) -> Details:
-        browser.get(url)
-        xpath = "//div[@id = 'property-details']"
-        results = browser.find_elements_by_xpath(xpath)
-        if len(results) == 0:
-            self.logger.warn(
-                f"Can't find Immovlan formatted details for {url=}")
-            return Details(url)
-        info = results[0]
-        self.logger.debug(f"Found some details for {url=}")
-        street_xpath = ".//span[contains(@class, 'street-line')]"
-        try:
-            street = info.find_element_by_xpath(street_xpath)\
-                         .get_attribute("innerHTML").strip()
-        except NoSuchElementException:
-            street = "No exact address"
-        # TODO Exception handling if no address ?
-        city_xpath = ".//span[contains(@class, 'city-line')]"
-        city = info.find_element_by_xpath(city_xpath).text.strip()
-        address = f"{city} | {street}"
-        price_xpath = ".//span[contains(@class, 'price-label')]"
-        price_elem = info.find_element_by_xpath(price_xpath)
-        price = int(price_elem.text.strip()
-                              .replace("\u202f", "")[:-1]
-                              .strip().split(' ')[-1])
-        text_xpath = ".//div[@class = 'ico-text']"
-        bedroom_xpath = ".//div[contains(@class, 'NrOfBedrooms')]"
-        bedroom_elem = info.find_element_by_xpath(bedroom_xpath)
-        bedrooms = int(bedroom_elem.find_element_by_xpath(text_xpath)
-                                   .get_attribute("innerHTML").strip())
-        area_xpath = ".//div[contains(@class, 'LivableSurface')]"
-        try:
-            area_elem = info.find_element_by_xpath(area_xpath)
-            area = int(area_elem.find_element_by_xpath(text_xpath)
-                                .get_attribute("innerHTML")
-                                .strip().split(" ")[0])
-        except NoSuchElementException:
-            area = None
-        # TODO add agency name, PEB, garden size, bathrooms
-        return CompleteDetails(url, price, address, bedrooms, area)
+    site = "immovlan"
+    rules = IMMOVLAN_RULES
+
+    def __details__(self, url: str, fields: Dict[str, Any]) -> Details:
+        # immovlan splits the address over two lines
+        street = fields.pop("street")
+        city = fields.pop("city")
+        return CompleteDetails(url, address=f"{city} | {street}", **fields)
 
 
 class ImmovlanSearcher(Searcher):
@@ -76,9 +69,9 @@ class ImmovlanSearcher(Searcher):
         self.url = self.conf["immovlan.search_url"] + url_params
         # TODO replace print with proper log
         self.logger.debug(f"Immovlan search {self.url=}")
-        self.maxpages = 1
 
-    def search_all(self):
+    def search_page(self, page_nb: int,
+                    skip_unchanged: bool = False) -> Dict[str, str]:
         properties = {}
 
         def find_id(element):
@@ -96,15 +89,22 @@ class ImmovlanSearcher(Searcher):
             """
             return element.find_element_by_tag_name("a").get_attribute("href")
 
-        for page in range(1, self.maxpages + 1):
-            self.browser.get(f"{self.url}&noindex={str(page)}")
-            xpath = "//article[@class='list-view-item mb-3 card card-border']"
-            results = self.browser.find_elements_by_xpath(xpath)
+        xpath = "//article[@class='list-view-item mb-3 card card-border']"
+        page_url = f"{self.url}&noindex={str(page_nb)}"
+        with self.engine.open(page_url) as page:
+            ids_xpath = f"{xpath}//button[@class='btn btn-favorite']"\
+                        "/@data-value-id"
+            if skip_unchanged:
+                known = self.__unchanged__(self.name, page_nb, page,
+                                           ids_xpath)
+                if known is not None:
+                    return known
+            results = page.find_elements_by_xpath(xpath)
             if len(results) == 0:
                 self.logger.warn(f"No results found fitting {xpath=}")
             else:
-                properties.update({find_id(result): find_link(result)
-                                   for result in results})
+                properties.update(self.__listings__(results, find_id,
+                                                    find_link))
         return properties
 
 
@@ -1,46 +1,61 @@
-from selenium import webdriver
 from pyhocon import ConfigFactory
+from typing import List
+from typing import Dict
 from typing import Optional
 
 from logging_utils import initLogging
 from details import DetailFinder
-from details import Details
-from details import CompleteDetails
 from details import SeleniumDetailFinder
+from extract import Rule
+from extract import RuleSet
+from extract import lines
 from search import Searcher
 
 
+def parse_address(infos: List[str]) -> str:
+    return infos[-2].replace("Ask for the exact address", "No exact address")
+
+
+def parse_price(infos: List[str]) -> int:
+    return [int(line[:-1].split(" ")[-1])
+            for line in infos if
+            line.endswith('€')][0]
+
+
+def bedrooms_area_lines(infos: List[str]) -> List[List[str]]:
+    return [line.split('|') for line in infos if line.endswith('m²')]
+
+
+def parse_bedrooms(infos: List[str]) -> Optional[int]:
+    bedrooms_area = bedrooms_area_lines(infos)
+    if len(bedrooms_area) == 0:
+        return int([line.strip().split(" ")[0] for line in infos if
+                    line.endswith("bedrooms")][0])
+    if len(bedrooms_area[0]) > 1:
+        return int(bedrooms_area[0][-2].strip().split(' ')[0])
+    return None
+
+
+def parse_area(infos: List[str]) -> Optional[int]:
+    bedrooms_area = bedrooms_area_lines(infos)
+    if len(bedrooms_area) == 0:
+        return None
+    return int(bedrooms_area[0][-1].strip().split(' ')[0])
+
+
+# Immoweb shows all of its details as lines of text in the header
+IMMOWEB_RULES = RuleSet(
+    container="//div[@class ='classified__header-content']",
+    rules=[Rule("price", ".", parse_price, read=lines),
+           Rule("address", ".", parse_address, read=lines),
+           Rule("bedrooms", ".", parse_bedrooms, read=lines),
+           Rule("area", ".", parse_area, read=lines)])
+# TODO add agency name, PEB, garden size, bathrooms
+
+
 class ImmowebDetailFinder(SeleniumDetailFinder):
-    def __findDetail__(self, url: str, browser: webdriver) -> Details:
-        browser.get(url)
-        xpath = "//div[@class ='classified__header-content']"
-        results = browser.find_elements_by_xpath(xpath)
-        if len(results) == 0:
-            self.logger.warn(
-                f"Can't find Immoweb formatted details for {url=}")
-            return Details(url)
-        self.logger.debug(f"Found some details for {url=}")
-        infos = [line.strip() for line in results[0].text.split("\n")]
-        address = infos[-2].replace("Ask for the exact address",
-                                    "No exact address")
-        price = [int(line[:-1].split(" ")[-1])
-                 for line in infos if
-                 line.endswith('€')][0]
-        bedrooms_area_lines = [line.split('|')
-                               for line in infos if
-                               line.endswith('m²')]
-        bedrooms = None
-        area = None
-        if len(bedrooms_area_lines) == 0:
-            bedrooms = int([line.strip().split(" ")[0] for line in infos if
-                            line.endswith("bedrooms")][0])
-        else:
-            bedrooms_area = bedrooms_area_lines[0]
-            area = int(bedrooms_area.pop().strip().split(' ')[0])
-            if len(bedrooms_area) > 0:
-                bedrooms = int(bedrooms_area.pop().strip().split(' ')[0])
-        # TODO add agency name, PEB, garden size, bathrooms
-        return CompleteDetails(url, price, address, bedrooms, area)
+    site = "immoweb"
+    rules = IMMOWEB_RULES
 
 
 class ImmowebSearcher(Searcher):
@@ -65,9 +80,9 @@ class ImmowebSearcher(Searcher):
         self.url = self.conf["immoweb.search_url"] + url_params
         # TODO replace print with proper log
         self.logger.debug(f"Immoweb search {self.url=}")
-        self.maxpages = 1
 
-    def search_all(self):
+    def search_page(self, page_nb: int,
+                    skip_unchanged: bool = False) -> Dict[str, str]:
         properties = {}
 
         def find_id(element):
@@ -83,15 +98,20 @@ class ImmowebSearcher(Searcher):
             """
             return element.find_element_by_tag_name("a").get_attribute("href")
 
-        for page in range(1, self.maxpages + 1):
-            self.browser.get(f"{self.url}&page={str(page)}")
+        page_url = f"{self.url}&page={str(page_nb)}"
+        with self.engine.open(page_url) as page:
             xpath = "//article[starts-with(@id, 'classified_')]"
-            results = self.browser.find_elements_by_xpath(xpath)
+            if skip_unchanged:
+                known = self.__unchanged__(self.name, page_nb, page,
+                                           f"{xpath}/@id")
+                if known is not None:
+                    return known
+            results = page.find_elements_by_xpath(xpath)
             if len(results) == 0:
                 self.logger.warn(f"No results found fitting {xpath=}")
             else:
-                properties.update({find_id(result): find_link(result)
-                                   for result in results})
+                properties.update(self.__listings__(results, find_id,
+                                                    find_link))
         return properties
 
 
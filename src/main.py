@@ -1,11 +1,10 @@
-from pyhocon import ConfigFactory
-
+from config import load_conf
 from logging_utils import initLogging
 from immoBot import ImmoBotTelegram
 from immoBot import allSearchersFactory
 
 if __name__ == '__main__':
-    conf = ConfigFactory.parse_file("configuration/myConf.conf")
+    conf = load_conf("configuration/myConf.conf")
     initLogging(conf)
     bot = ImmoBotTelegram(conf, allSearchersFactory)
     bot.start()
@@ -0,0 +1,134 @@
+from pyhocon import ConfigFactory
+from contextlib import contextmanager
+from typing import Dict
+from typing import Tuple
+import http.server
+import json
+import threading
+import time
+from logging import getLogger
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics():
+    """
+    Counters, gauges and timings of the bot hot paths,
+    labelled by site and stage, exported in the Prometheus text format
+    or as json lines.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Key, float] = {}
+        self.gauges: Dict[Key, float] = {}
+        # name + labels -> [count, sum, max]
+        self.timings: Dict[Key, list] = {}
+
+    @staticmethod
+    def __key__(name: str, labels: Dict[str, str]) -> Key:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self.__key__(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges[self.__key__(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self.__key__(name, labels)
+        with self.lock:
+            timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def timed(self, name: str, **labels):
+        """ Time the with block, failed or not """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def __labels__(labels: Tuple[Tuple[str, str], ...]) -> str:
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join([f'{k}="{v}"' for k, v in labels]) + "}"
+
+    def prometheus(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"immobot_{name}{self.__labels__(labels)} "
+                             f"{value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"immobot_{name}{self.__labels__(labels)} "
+                             f"{value}")
+            for (name, labels), (count, total, highest) in\
+                    sorted(self.timings.items()):
+                suffix = self.__labels__(labels)
+                lines.append(f"immobot_{name}_count{suffix} {count}")
+                lines.append(f"immobot_{name}_sum{suffix} {total}")
+                lines.append(f"immobot_{name}_max{suffix} {highest}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        """ All metrics as a json serializable dict """
+        def flat(key: Key) -> str:
+            name, labels = key
+            return name + self.__labels__(labels)
+        with self.lock:
+            return {"time": time.time(),
+                    "counters": {flat(k): v
+                                 for k, v in self.counters.items()},
+                    "gauges": {flat(k): v for k, v in self.gauges.items()},
+                    "timings": {flat(k): {"count": v[0], "sum": v[1],
+                                          "max": v[2]}
+                                for k, v in self.timings.items()}}
+
+    def append_jsonl(self, path: str) -> None:
+        with open(path, "a") as jsonl:
+            jsonl.write(json.dumps(self.snapshot()) + "\n")
+
+    def serve(self, port: int) -> http.server.HTTPServer:
+        """ Expose the metrics on http://<host>:<port>/metrics """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        server = http.server.ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name="metrics").start()
+        getLogger().info(f"Serving metrics on port {port}")
+        return server
+
+
+# metrics of the whole process
+metrics = Metrics()
+
+
+def start_export(conf: ConfigFactory) -> None:
+    """ Start serving metrics if 'general.metrics.port' is set """
+    port = conf.get("general.metrics.port", None)
+    if port:
+        metrics.serve(port)
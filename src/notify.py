@@ -0,0 +1,183 @@
+from pyhocon import ConfigFactory
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Tuple
+import sqlite3
+import threading
+import time
+from logging import getLogger
+
+from metrics import metrics
+
+
+class Outbox():
+    """
+    Persistent queue of the messages waiting to be sent.
+    A message only leaves the outbox once it was successfully sent,
+    so that none is lost if the bot dies in the middle of sending.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                            " message TEXT NOT NULL,"
+                            " chat TEXT,"
+                            " attempts INTEGER NOT NULL DEFAULT 0,"
+                            " next_try REAL NOT NULL)")
+            columns = [column[1] for column in
+                       self.db.execute("PRAGMA table_info(outbox)")]
+            # outboxes of older versions only had the default chat
+            if "chat" not in columns:
+                self.db.execute("ALTER TABLE outbox ADD COLUMN chat TEXT")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def put(self, messages: List[str], chat: Optional[str] = None) -> None:
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO outbox "
+                                "(message, chat, next_try) VALUES (?, ?, ?)",
+                                [(message, chat, now)
+                                 for message in messages])
+
+    def due(self, limit: int
+            ) -> Tuple[Optional[str], List[Tuple[int, str, int]]]:
+        """
+        Oldest messages due to be (re)tried, all going to the same chat:
+        the chat and the (id, message, attempts) of the messages.
+        """
+        now = time.time()
+        with self.lock:
+            oldest = self.db.execute("SELECT chat FROM outbox "
+                                     "WHERE next_try <= ? ORDER BY id "
+                                     "LIMIT 1", [now]).fetchone()
+            if oldest is None:
+                return None, []
+            chat = oldest[0]
+            return chat, self.db.execute("SELECT id, message, attempts "
+                                         "FROM outbox WHERE next_try <= ? "
+                                         "AND chat IS ? ORDER BY id LIMIT ?",
+                                         [now, chat, limit]).fetchall()
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox")\
+                          .fetchone()[0]
+
+    def sent(self, ids: List[int]) -> None:
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM outbox WHERE id = ?",
+                                [(message_id, ) for message_id in ids])
+
+    def postpone(self, ids: List[int], delay: float) -> None:
+        with self.lock, self.db:
+            self.db.executemany("UPDATE outbox SET attempts = attempts + 1, "
+                                "next_try = ? WHERE id = ?",
+                                [(time.time() + delay, message_id)
+                                 for message_id in ids])
+
+
+class TokenBucket():
+    """ Allow 'rate' messages per second, with bursts up to 'capacity' """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, count: int, stop: threading.Event) -> bool:
+        """
+        Wait for enough tokens to send 'count' messages.
+        Gives up (returning False) if the stop event is set meanwhile.
+        """
+        count = min(count, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return True
+            if stop.wait((count - self.tokens) / self.rate):
+                return False
+
+
+class Notifier(threading.Thread):
+    """
+    Background dispatcher sending the messages of the outbox,
+    in batches of 'batch' messages, rate limited by a token bucket
+    and retried with an exponential backoff when sending fails.
+    """
+
+    def __init__(self, conf: ConfigFactory,
+                 send: Callable[[List[str], Optional[str]], None]):
+        super().__init__(name="notifier", daemon=True)
+        shelve_dir = conf["general.shelve_dir"]
+        self.outbox = Outbox(conf.get("general.notify.outbox",
+                                      f"{shelve_dir}outbox.sqlite"))
+        self.send = send
+        self.batch = conf.get("general.notify.batch", 10)
+        self.bucket = TokenBucket(conf.get("general.notify.rate", 1.0),
+                                  conf.get("general.notify.burst", 10))
+        self.min_delay = conf.get("general.notify.retry_delay", 5)
+        self.max_delay = conf.get("general.notify.max_retry_delay", 600)
+        self.logger = getLogger()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+    def enqueue(self, messages: List[str],
+                chat: Optional[str] = None) -> None:
+        """ Queue messages to be sent, without waiting for them to be """
+        self.outbox.put(messages, chat)
+        metrics.inc("messages_queued_total", len(messages))
+        self.wake.set()
+
+    def run(self) -> None:
+        pending = self.outbox.pending()
+        if pending > 0:
+            self.logger.info(f"Resuming the sending of {pending} messages")
+        while not self.stopping.is_set():
+            chat, due = self.outbox.due(self.batch)
+            if len(due) == 0:
+                # sleep until new messages or a retry is due
+                self.wake.wait(self.min_delay)
+                self.wake.clear()
+                continue
+            if not self.bucket.take(len(due), self.stopping):
+                break
+            self.__dispatch__(chat, due)
+
+    def __dispatch__(self, chat: Optional[str],
+                     due: List[Tuple[int, str, int]]) -> None:
+        ids = [message_id for message_id, _, _ in due]
+        try:
+            with metrics.timed("send_seconds"):
+                self.send([message for _, message, _ in due], chat)
+        except Exception:
+            attempts = max([attempts for _, _, attempts in due])
+            delay = min(self.max_delay, self.min_delay * 2 ** attempts)
+            self.logger.exception(f"Failed sending {len(due)} messages, "
+                                  f"retrying in {delay}s")
+            metrics.inc("send_failures_total")
+            self.outbox.postpone(ids, delay)
+            return
+        self.outbox.sent(ids)
+        metrics.inc("messages_sent_total", len(ids))
+
+    def stop(self) -> None:
+        """
+        Stop sending, messages not sent yet are kept in the outbox
+        for the next start.
+        """
+        self.stopping.set()
+        self.wake.set()
+        self.join()
+        self.outbox.close()
@@ -0,0 +1,133 @@
+from pyhocon import ConfigFactory
+from contextlib import nullcontext
+from typing import Iterator
+from typing import List
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import queue
+import threading
+from logging import getLogger
+
+from dedup import Fingerprint
+from dedup import open_index
+from details import CompleteDetails
+from details import Details
+from metrics import metrics
+
+# tells the next stage that the previous one is done
+DONE = None
+
+
+def stream(conf: ConfigFactory, searchers: List,
+           deduplicate: bool = False) -> Iterator[Tuple[str, Details]]:
+    """
+    Search new properties on every searcher and yield each one with its
+    full details as soon as it got them, instead of once every website
+    was searched and every property detailed.
+
+    Searchers run on up to 'general.parallel.workers' threads and hand
+    the new properties of each page over to 'general.details.workers'
+    threads fetching their details. Stages are connected by queues of
+    'general.pipeline.queue' properties at most: searching waits for
+    the details to catch up rather than piling up properties.
+    When 'deduplicate' is set, a property already reported from another
+    website is skipped.
+    """
+    logger = getLogger()
+    size = conf.get("general.pipeline.queue", 20)
+    workers = conf.get("general.details.workers", 1)
+    timeout = conf.get("general.parallel.timeout", None)
+    found = queue.Queue(maxsize=size)
+    detailed = queue.Queue(maxsize=size)
+    # set once the searchers are no longer waited for
+    closed = threading.Event()
+
+    def search(searcher) -> None:
+        # a property can show up in several partitions of a website
+        emitted = set()
+        lock = threading.Lock()
+
+        def emit(prop: str, url: str) -> None:
+            with lock:
+                if prop in emitted:
+                    return
+                emitted.add(prop)
+            # a searcher running late gives up once nothing reads the
+            # queue anymore, its properties are resumed by the next search
+            while not closed.is_set():
+                try:
+                    found.put((searcher, prop, url), timeout=1)
+                except queue.Full:
+                    continue
+                metrics.set("pipeline_queued", found.qsize(), stage="detail")
+                return
+        try:
+            with metrics.timed("search_seconds", site=searcher.name):
+                searcher.stream_new(emit)
+        except Exception:
+            logger.exception(f"Searcher {searcher.name} failed, "
+                             "skipping its results")
+
+    def detail() -> None:
+        while True:
+            item = found.get()
+            if item is DONE:
+                detailed.put(DONE)
+                return
+            searcher, prop, url = item
+            try:
+                results = searcher.detail({prop: url})
+            except Exception:
+                logger.exception(f"Failed detailing {prop}, "
+                                 "sending it without details")
+                results = {prop: Details(url)}
+            for prop, details in results.items():
+                detailed.put((searcher, prop, details))
+
+    def coordinate() -> None:
+        executor = ThreadPoolExecutor(
+            max_workers=conf.get("general.parallel.workers", 1),
+            thread_name_prefix="searcher")
+        futures = [executor.submit(search, searcher)
+                   for searcher in searchers]
+        _, late = wait(futures, timeout=timeout)
+        if len(late) > 0:
+            logger.error(f"{len(late)} searchers timed out after "
+                         f"{timeout}s, not waiting for them")
+        executor.shutdown(wait=False, cancel_futures=True)
+        closed.set()
+        for _ in range(workers):
+            found.put(DONE)
+
+    threading.Thread(target=coordinate, name="pipeline",
+                     daemon=True).start()
+    for number in range(workers):
+        threading.Thread(target=detail, name=f"detail-{number}",
+                         daemon=True).start()
+    finished = 0
+    with open_index(conf) if deduplicate else nullcontext() as index:
+        while finished < workers:
+            item = detailed.get()
+            if item is DONE:
+                finished += 1
+                continue
+            searcher, prop, details = item
+            if index is not None and already_reported(index, prop, details):
+                searcher.notified([prop])
+                continue
+            yield prop, details
+
+
+def already_reported(index, prop: str, details: Details) -> bool:
+    """ Whether the property was already reported from another website """
+    if not isinstance(details, CompleteDetails):
+        return False
+    fingerprint = Fingerprint.of(details)
+    same = index.find(details.url, fingerprint)
+    if same is None:
+        index.add(details.url, fingerprint)
+        return False
+    getLogger().info(f"Property {prop} is a duplicate of already reported "
+                     f"{same}, skipping it")
+    return True
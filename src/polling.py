@@ -0,0 +1,60 @@
+from pyhocon import ConfigFactory
+from typing import Dict
+import random
+import time
+from logging import getLogger
+
+from metrics import metrics
+from seen import SeenStore
+
+
+class Poller():
+    """
+    Decide when each source of properties (a website, or one location of
+    a website) is due to be searched again.
+    Every source is polled about as often as it takes for
+    'general.polling.target' new properties to show up on it,
+    going by how many showed up in the last 'general.polling.window' hours,
+    bounded by 'min_interval' and 'max_interval' minutes and shifted by
+    a random 'jitter' so that sources do not all come due at once.
+    Sources are never polled less often than every 'general.bot.frequency'
+    minutes unless 'max_interval' says otherwise.
+    Without 'general.polling.adaptive', every source is always due.
+    """
+
+    def __init__(self, conf: ConfigFactory, seen: SeenStore):
+        self.seen = seen
+        self.adaptive = conf.get("general.polling.adaptive", False)
+        self.min_interval = conf.get("general.polling.min_interval", 5) * 60
+        self.max_interval = conf.get(
+            "general.polling.max_interval",
+            conf.get("general.bot.frequency", 15)) * 60
+        self.target = conf.get("general.polling.target", 1)
+        self.window = conf.get("general.polling.window", 168) * 3600
+        self.jitter = conf.get("general.polling.jitter", 0.1)
+        self.logger = getLogger()
+        # source -> time.monotonic() at which it is due again
+        self.next_poll: Dict[str, float] = {}
+
+    def due(self, source: str) -> bool:
+        if not self.adaptive:
+            return True
+        return time.monotonic() >= self.next_poll.get(source, 0)
+
+    def interval(self, source: str) -> float:
+        """ Seconds to wait before polling the source again """
+        arrivals = self.seen.arrivals(source, time.time() - self.window)
+        if arrivals == 0:
+            return self.max_interval
+        interval = self.target * self.window / arrivals
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def polled(self, source: str) -> None:
+        """ Schedule the next poll of a source which was just searched """
+        if not self.adaptive:
+            return
+        interval = self.interval(source)
+        metrics.set("poll_interval_seconds", interval, site=source)
+        interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.next_poll[source] = time.monotonic() + interval
+        self.logger.debug(f"Next search of {source} in {interval:.0f}s")
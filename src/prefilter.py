@@ -0,0 +1,78 @@
+from pyhocon import ConfigFactory
+from typing import Optional
+from dataclasses import dataclass
+import re
+
+# numbers as the websites write them: 1,300,000 or 1 955 000 or 1450000
+AMOUNT = r"(\d{1,3}(?:[ ,.  ]\d{3})+|\d+)"
+PRICE = re.compile(rf"€\s*{AMOUNT}|{AMOUNT}\s*€")
+# decimals of areas, as in 120,5 m², are left out
+AREA = re.compile(rf"{AMOUNT}(?:[.,]\d{{1,2}})?\s*m²")
+BEDROOMS = re.compile(r"(\d+)\s*(?:bdr|beds?|bedrooms?|ch|chambres?|"
+                      r"slaapkamers?)\b", re.IGNORECASE)
+
+
+def first_number(pattern: re.Pattern, text: str) -> Optional[int]:
+    match = pattern.search(text)
+    if match is None:
+        return None
+    number = next(group for group in match.groups() if group is not None)
+    return int(re.sub(r"\D", "", number))
+
+
+@dataclass(slots=True)
+class Card:
+    """
+    What the list of results already tells about a property,
+    any of it possibly missing.
+    """
+    text: str
+    price: Optional[int]
+    bedrooms: Optional[int]
+    area: Optional[int]
+
+    @classmethod
+    def of(cls, text: str) -> "Card":
+        """ Read the card out of its text as rendered by a browser """
+        return cls(text, first_number(PRICE, text),
+                   first_number(BEDROOMS, text), first_number(AREA, text))
+
+
+class CardFilter():
+    """
+    Properties not worth looking at in details, going by their card:
+    smaller than 'min_area' m², with less than 'min_bedrooms' bedrooms,
+    more expensive than 'max_price_per_sqm' or whose card holds any of
+    the 'exclude' keywords, as configured in 'general.filter'.
+    Unknown values never reject a property.
+    """
+
+    def __init__(self, conf: ConfigFactory):
+        self.min_area = conf.get("general.filter.min_area", 0)
+        self.min_bedrooms = conf.get("general.filter.min_bedrooms", 0)
+        self.max_price_per_sqm = conf.get("general.filter.max_price_per_sqm",
+                                          0)
+        self.exclude = [keyword.lower() for keyword
+                        in conf.get("general.filter.exclude", [])]
+
+    @property
+    def enabled(self) -> bool:
+        return any([self.min_area, self.min_bedrooms,
+                    self.max_price_per_sqm, self.exclude])
+
+    def reject(self, card: Card) -> Optional[str]:
+        """ Why the property is not worth detailing, None if it is """
+        if self.min_area and card.area is not None and\
+                card.area < self.min_area:
+            return f"area of {card.area}m²"
+        if self.min_bedrooms and card.bedrooms is not None and\
+                card.bedrooms < self.min_bedrooms:
+            return f"{card.bedrooms} bedrooms"
+        if self.max_price_per_sqm and card.price and card.area and\
+                card.price / card.area > self.max_price_per_sqm:
+            return f"price of {card.price / card.area:.0f}€/m²"
+        text = card.text.lower()
+        for keyword in self.exclude:
+            if keyword in text:
+                return f"'{keyword}' in its description"
+        return None
@@ -1,61 +1,58 @@
-from selenium import webdriver
 from pyhocon import ConfigFactory
-from typing import Optional
+from typing import Callable
+from typing import Dict
 from typing import List
-import copy
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait as wait
+from typing import Optional
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 
 from logging_utils import initLogging
 from details import DetailFinder
-from details import Details
-from details import CompleteDetails
 from details import SeleniumDetailFinder
+from extract import Rule
+from extract import RuleSet
 from search import Searcher
-from search import MultiSearcher
+
+
+def get_value_at_line_starting_with(features: str, prefix: str) -> str:
+    relevant_line = [line.strip() for line in features.split("\n")
+                     if line.startswith(prefix)][0]
+    return relevant_line.split(" ")[-1]
+
+
+def parse_bedrooms(features: str) -> int:
+    return int(get_value_at_line_starting_with(features, "Bedrooms"))
+
+
+def parse_area(features: str) -> int:
+    return int(get_value_at_line_starting_with(features,
+                                               "Habitable area")[:-2])
+
+
+REALO_RULES = RuleSet(
+    container="//div[@class='property__container']",
+    rules=[Rule("address", ".//h1[@class='address']"),
+           Rule("price", ".//span[@itemprop = 'price']", int),
+           Rule("bedrooms", ".//div[@class = 'component-property-features']",
+                parse_bedrooms),
+           Rule("area", ".//div[@class = 'component-property-features']",
+                parse_area)])
+# TODO add agency name, PEB, garden size, bathrooms
 
 
 class RealoDetailFinder(SeleniumDetailFinder):
-    def __findDetail__(self, url: str, browser: webdriver) -> Details:
-        browser.get(url)
-        xpath = "//div[@class='property__container']"
-        results = browser.find_elements_by_xpath(xpath)
-        if len(results) == 0:
-            self.logger.warn(
-                f"Can't find Realo formatted details for {url=}")
-            return Details(url)
-        info = results[0]
-        self.logger.debug(f"Found some details for {url=}")
-        address_xpath = ".//h1[@class='address']"
-        address = info.find_element_by_xpath(address_xpath)\
-                      .get_attribute("innerHTML").strip()
-        price_xpath = ".//span[@itemprop = 'price']"
-        price_elem = info.find_element_by_xpath(price_xpath)
-        price = int(price_elem.get_attribute("innerHTML").strip())
-        features_xpath = ".//div[@class = 'component-property-features']"
-        features = info.find_element_by_xpath(features_xpath).text.split("\n")
-
-        def get_value_at_line_starting_with(lines: List[str],
-                                            prefix: str) -> str:
-            relevant_line = [line.strip() for line in lines
-                             if line.startswith(prefix)][0]
-            return relevant_line.split(" ")[-1]
-        bedrooms = int(get_value_at_line_starting_with(features, "Bedrooms"))
-        area = int(get_value_at_line_starting_with(features,
-                                                   "Habitable area")[:-2])
-        # TODO add agency name, PEB, garden size, bathrooms
-        return CompleteDetails(url, price, address, bedrooms, area)
-
-
-class SingleRealoSearcher(Searcher):
+    site = "realo"
+    rules = REALO_RULES
+
+
+class RealoSearcher(Searcher):
     """
     Realo website only allows to look for one location at a time.
-    To go around this, the realo searcher is split between a searcher
-    handling one location and one orchestrating multiple
-    single location searchers.
-
-    This is the single location realo searcher class.
+    To go around this, the realo searcher runs one query per location,
+    all of them sharing the same fetch engine and seen store,
+    the latter being partitioned by location.
+    Locations are searched concurrently on up to 'realo.workers' threads.
     """
     name = "realo"
 
@@ -64,23 +61,34 @@ class SingleRealoSearcher(Searcher):
         if detailFinder is None:
             detailFinder = RealoDetailFinder(conf)
         super().__init__(conf, detailFinder)
-        if detailFinder is None:
-            self.detailFinder = RealoDetailFinder(conf)
-        else:
-            self.detailFinder = detailFinder
         search_config = dict(self.conf["realo.search"])
-        # turn postal codes config into a single string
-        postalCode = self.conf["realo.postalCode"]
-        self.name = f"realo{postalCode}"
-        # dirty hack to keep conf sane
-        self.conf.put(f"realo{postalCode}", self.conf["realo"])
-        url_params = '&'.join(["%s=%s" % item for
-                               item in search_config.items()])
-        self.url = f"{self.conf['realo.search_url']}{postalCode}?{url_params}"
-        # TODO replace print with proper log
-        self.logger.debug(f"Realo search {self.url=}")
-
-    def search_all(self):
+        self.postalCodes = search_config.pop("postalCodes")
+        self.url_params = '&'.join(["%s=%s" % item for
+                                    item in search_config.items()])
+        self.logger.debug(f"Realo search in {self.postalCodes=} "
+                          f"with {self.url_params=}")
+
+    def __enter__(self):
+        super().__enter__()
+        # carry over the properties seen by older versions of the bot,
+        # which used to keep one shelve per location
+        shelve_dir = self.conf["general.shelve_dir"]
+        for postalCode in self.postalCodes:
+            self.seen.migrate_shelve(self.partition(postalCode),
+                                     f"{shelve_dir}realo{postalCode}")
+        return self
+
+    @staticmethod
+    def partition(postalCode: int) -> str:
+        return f"realo{postalCode}"
+
+    def url(self, postalCode: int) -> str:
+        return (f"{self.conf['realo.search_url']}{postalCode}?"
+                f"{self.url_params}")
+
+    def search_location_page(self, postalCode: int, page_nb: int,
+                             skip_unchanged: bool = False
+                             ) -> Dict[str, str]:
         properties = {}
 
         def find_id(element):
@@ -95,55 +103,86 @@ class SingleRealoSearcher(Searcher):
             Link to property on Realo is directly in the container
             but it is a relative link so we need to add back the root.
             """
-            return f"https://www.realo.be{element.get_attribute('data-href')}"
-        self.browser.get(f"{self.url}")
-        # Realo being quite slow, we wait until at least an element has loaded
-
-        list_xpath = "//div[@class = 'module-listings']"
-        list_of_properties = wait(self.browser, 5).until(
-            EC.presence_of_element_located((By.XPATH, list_xpath)))
-        # JavaScript Executor to stop page load
-        # as otherwise realo keeps loading
-        self.browser.execute_script("window.stop();")
-        xpath = ".//div[@data-scope = 'componentEstateGridItem']"
-        # TODO handle error if no list of properties
-        results = list_of_properties.find_elements_by_xpath(xpath)
-        if len(results) == 0:
-            self.logger.warn(f"No results found fitting {xpath=}")
-        else:
-            properties.update({find_id(result): find_link(result)
-                               for result in results})
+            return urljoin(self.conf["realo.search_url"],
+                           element.get_attribute('data-href'))
+        page_url = f"{self.url(postalCode)}&page={str(page_nb)}"
+        with self.engine.open(page_url) as page:
+            # Realo being quite slow,
+            # we wait until at least an element has loaded
+            list_xpath = "//div[@class = 'module-listings']"
+            list_of_properties = page.wait_for(list_xpath, 5)
+            # stop page load as otherwise realo keeps loading
+            page.stop()
+            xpath = ".//div[@data-scope = 'componentEstateGridItem']"
+            if skip_unchanged:
+                known = self.__unchanged__(self.partition(postalCode),
+                                           page_nb, page,
+                                           f"{list_xpath}{xpath[1:]}/@id")
+                if known is not None:
+                    return known
+            # TODO handle error if no list of properties
+            results = list_of_properties.find_elements_by_xpath(xpath)
+            if len(results) == 0:
+                self.logger.warn(f"No results found fitting {xpath=}")
+            else:
+                properties.update(self.__listings__(results, find_id,
+                                                    find_link))
         return properties
 
+    def __each_location__(self, action: Callable[[int], Tuple]) -> List:
+        """
+        Run the action for every location, concurrently,
+        giving back the results in the order of the locations.
+        A failing location is logged and gives back None.
+        """
+        def run(postalCode: int) -> Optional[Tuple]:
+            try:
+                return action(postalCode)
+            except Exception:
+                self.logger.exception(f"Realo search in {postalCode} "
+                                      "failed, skipping it")
+                return None
+        workers = self.conf.get("realo.workers",
+                                self.conf.get("general.parallel.workers", 1))
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix="realo") as executor:
+            return list(executor.map(run, self.postalCodes))
+
+    def search_page(self, page_nb: int,
+                    skip_unchanged: bool = False) -> Dict[str, str]:
+        properties = {}
+        for found in self.__each_location__(
+                lambda postalCode: self.search_location_page(
+                    postalCode, page_nb, skip_unchanged)):
+            properties.update(found or {})
+        return properties
 
-class RealoSearcher(MultiSearcher):
-    """
-    Realo website only allows to look for one location at a time.
-    To go around this, the realo searcher is split between a searcher
-    handling one location and one orchestrating multiple
-    single location searchers.
-
-    This is the orchestrator realo searcher class.
-    """
-    name = "Realo"
-
-    def __init__(self, conf: ConfigFactory,
-                 detailFinder: Optional[DetailFinder] = None):
-        postalCodes = conf["realo.search.postalCodes"]
-        searchers = []
-
-        def copyConfForSingleLocation(conf: ConfigFactory,
-                                      postalCode: int) -> ConfigFactory:
-            cp_conf = copy.deepcopy(conf)
-            cp_conf.pop("realo.search.postalCodes")
-            cp_conf.put("realo.postalCode", postalCode)
-            return cp_conf
-        searchers = [SingleRealoSearcher(copyConfForSingleLocation(conf,
-                                                                   postalCode),
-                                         detailFinder)
-                     for postalCode in postalCodes]
-
-        super().__init__(conf, searchers)
+    def __find_all_new__(self,
+                         emit: Optional[Callable[[str, str], None]] = None
+                         ) -> Tuple[Dict[str, str], Dict[str, str]]:
+        all_properties = {}
+        new_properties = {}
+
+        def find_new(postalCode: int) -> Tuple:
+            return self.__find_new__(
+                self.partition(postalCode),
+                lambda page_nb: self.search_location_page(
+                    postalCode, page_nb, skip_unchanged=True),
+                emit)
+        for found in self.__each_location__(find_new):
+            if found is not None:
+                all_properties.update(found[0])
+                new_properties.update(found[1])
+        return all_properties, new_properties
+
+    def forget(self, properties: List[str]) -> None:
+        for postalCode in self.postalCodes:
+            forgotten = self.seen.forget(self.partition(postalCode),
+                                         properties)
+            self.logger.debug(f"The following realo{postalCode} "
+                              f"properties were {forgotten = }")
+        # so that the pages listing them are read again
+        self.fingerprints.clear()
 
 
 def realoFactory(conf: ConfigFactory) -> Searcher:
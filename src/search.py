@@ -3,12 +3,36 @@ from pyhocon import ConfigFactory
 from typing import List
 from typing import Optional
 from typing import Dict
-import shelve
+from typing import Set
+from typing import Tuple
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+import hashlib
+import time
 from logging import getLogger
 
 from details import DetailFinder
 from details import Details
-from browser import launch_selenium
+from details import CompleteDetails
+from dedup import Fingerprint
+from dedup import open_index
+from fetch import open_engine
+from health import circuit
+from history import open_history
+from pipeline import stream
+from polling import Poller
+from prefilter import Card
+from prefilter import CardFilter
+from seen import DETAILED
+from seen import DISCOVERED
+from seen import NOTIFIED
+from seen import Job
+from seen import SeenStore
+from metrics import metrics
 
 
 class Searcher(ABC):
@@ -19,20 +43,39 @@ class Searcher(ABC):
             detailFinder = DetailFinder(conf)
         self.detailFinder = detailFinder
         self.logger = getLogger()
+        self.maxpages = 1
+        self.filter = CardFilter(conf)
+        # cards of the properties last found on the pages of results
+        self.cards: Dict[str, Card] = {}
+        # progress of the new properties until notified, checkpointed
+        # once per search
+        self.jobs: Dict[str, Job] = {}
+        # fingerprints of the pages of results of the last search of new
+        # properties along with what they listed, by partition and page,
+        # and those of the ongoing search
+        self.fingerprints: Dict[str, Dict[int, Tuple[str, Dict]]] = {}
+        self.new_fingerprints: Dict[str, Dict[int, Tuple[str, Dict]]] = {}
 
     def __enter__(self):
-        # startup selenium browser
-        self.browser = launch_selenium(self.conf["general"])
-        # open up connection to shelve
+        # startup the engine used to fetch pages from the website
+        self.engine = open_engine(self.conf, self.name)
+        # open up connection to the store of already seen properties
         shelve_dir = self.conf["general.shelve_dir"]
-        self.shelf = shelve.open(f"{shelve_dir}{self.name}")
-        if "prevs" not in self.shelf:  # first time setup
-            self.shelf["prevs"] = {}
+        self.seen = SeenStore(self.conf.get("general.seen_db",
+                                            f"{shelve_dir}seen.sqlite"),
+                              self.conf.get("general.seen_bloom", 0))
+        # carry over the properties seen by older versions of the bot
+        self.seen.migrate_shelve(self.name, f"{shelve_dir}{self.name}")
+        self.poller = Poller(self.conf, self.seen)
+        # history of the details of the properties reported, if kept
+        self.history = open_history(self.conf)
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self.shelf.close()
-        self.browser.quit()
+        self.seen.close()
+        if self.history is not None:
+            self.history.close()
+        self.engine.close()
         # no particular treatment in case of exceptions
 
     @property
@@ -41,41 +84,320 @@ class Searcher(ABC):
         pass
 
     @abstractmethod
-    def search_all(self) -> List[str]:
+    def search_page(self, page_nb: int,
+                    skip_unchanged: bool = False) -> Dict[str, str]:
         """
           Method to search properties on given immo provider
-          and find all the latest listings.
+          and find the listings on the given page of results,
+          pages being numbered from 1 and sorted newest first.
+          With 'skip_unchanged', a page unchanged since the last search
+          of new properties is not read again, see __unchanged__.
           Properties IDs and urls are returned
         """
         pass
 
-    def search_new(self) -> Dict[str, Details]:
+    def __unchanged__(self, partition: str, page_nb: int, page,
+                      ids_xpath: str) -> Optional[Dict[str, str]]:
+        """
+          The properties listed on the page of results at the last search
+          of new properties of the partition if it still lists the same
+          ones, going by the IDs at the given xpath, None otherwise.
+          Those are all seen already, the page needs not be read again.
+        """
+        if not self.conf.get("general.pagination.fingerprint", True):
+            return None
+        # test sends pick one of the properties listed, always read them
+        if self.conf.get(f"{self.name}.test_send", False):
+            return None
+        ids = "\n".join(page.strings(ids_xpath))
+        fingerprint = hashlib.sha1(ids.encode("utf-8")).hexdigest()
+        last, listed = self.fingerprints.get(partition, {}).get(
+            page_nb, (None, {}))
+        if last == fingerprint:
+            metrics.inc("page_fingerprint_total", site=partition,
+                        result="hit")
+            self.logger.debug(f"Page {page_nb} of {partition} unchanged "
+                              "since the last search")
+            return dict(listed)
+        metrics.inc("page_fingerprint_total", site=partition, result="miss")
+        # only trusted once its listings are recorded as seen, they are
+        # remembered along with it by __search_until_seen__
+        self.new_fingerprints.setdefault(partition, {})[page_nb] = (
+            fingerprint, {})
+        return None
+
+    def __listings__(self, results: List, find_id: Callable,
+                     find_link: Callable) -> Dict[str, str]:
+        """
+          IDs and urls of the given results of a page, keeping aside
+          their cards for the properties to be filtered before detailing.
+        """
+        properties = {}
+        for result in results:
+            prop = find_id(result)
+            properties[prop] = find_link(result)
+            if self.filter.enabled:
+                self.cards[prop] = Card.of(result.text)
+        return properties
+
+    def __prefilter__(self, properties: Dict[str, str]) -> Dict[str, str]:
+        """
+          The given properties worth detailing going by their cards,
+          see CardFilter.
+        """
+        kept = {}
+        for prop, url in properties.items():
+            card = self.cards.get(prop)
+            reason = None if card is None else self.filter.reject(card)
+            if reason is None:
+                kept[prop] = url
+            else:
+                self.logger.info(f"Skipping {self.name} property {prop} "
+                                 f"because of its {reason}")
+        metrics.inc("prefiltered_total", len(properties) - len(kept),
+                    site=self.name)
+        return kept
+
+    def search_all(self) -> Dict[str, str]:
         """
           Method to search properties on given immo provider
-          and find only the new listings not previously found.
-          IDs and full details are returned.
+          and find all the latest listings.
+          Properties IDs and urls are returned
+        """
+        properties = {}
+        for page_nb in range(1, self.maxpages + 1):
+            properties.update(self.search_page(page_nb))
+        return properties
+
+    def __search_until_seen__(self, partition: str,
+                              search_page: Callable[[int], Dict[str, str]]
+                              ) -> Tuple[Dict[str, str], Set[str]]:
+        """
+          Walk the pages of results newest first and stop at the first page
+          only holding already seen properties, or at the
+          'general.pagination.max_pages' safety ceiling.
+          All properties found and the ones among them already seen
+          are returned.
+        """
+        max_pages = self.conf.get("general.pagination.max_pages",
+                                  self.maxpages)
+        all_properties = {}
+        prevs = set()
+        for page_nb in range(1, max_pages + 1):
+            found = search_page(page_nb)
+            # a page read is remembered along with what it listed
+            pending = self.new_fingerprints.get(partition, {})
+            if page_nb in pending:
+                pending[page_nb] = (pending[page_nb][0], found)
+            all_properties.update(found)
+            prevs.update(self.seen.seen(partition, found.keys()))
+            if prevs.issuperset(found.keys()):
+                break
+        else:
+            if max_pages > 1:
+                self.logger.warn(f"Stopped after {max_pages} pages of new "
+                                 f"properties on {partition}, some older "
+                                 "new properties might have been missed")
+        return all_properties, prevs
+
+    def __find_new__(self, partition: str,
+                     search_page: Callable[[int], Dict[str, str]],
+                     emit: Optional[Callable[[str, str], None]] = None
+                     ) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """
+          Search the given pages for properties not seen before in the
+          partition of the seen store, and remember them as seen.
+          All properties found and the new ones are returned, nothing
+          being searched if the partition is not due to be polled yet
+          or if the searches of the website keep failing.
+          A search whose first page lists no property at all fails.
+          New properties not worth detailing going by their cards are
+          left out, see __prefilter__.
+          The ID and url of every new property are also handed to 'emit'
+          as soon as they are known.
         """
-        all_properties = self.search_all()
-        prevs = self.shelf["prevs"]
+        if not self.poller.due(partition):
+            return {}, {}
+        breaker = circuit(self.conf, self.name, "search")
+        if not breaker.allow():
+            return {}, {}
+        try:
+            all_properties, prevs = self.__search_until_seen__(partition,
+                                                               search_page)
+        except Exception:
+            breaker.failure()
+            self.new_fingerprints.pop(partition, None)
+            raise
+        if len(all_properties) == 0:
+            # even seen properties keep being listed, the listings
+            # were most likely not found because the markup changed
+            self.logger.warn(f"No properties listed on {partition}, "
+                             "counting it as a failed search")
+            breaker.failure()
+            self.new_fingerprints.pop(partition, None)
+            return {}, {}
+        breaker.success()
         new_properties = {k: v for
                           k, v in all_properties.items() if
                           k not in prevs}
+        kept = self.__prefilter__(new_properties)
+        jobs = {prop: Job(self.name, url) for prop, url in kept.items()}
+        # written ahead along with the new properties being seen
+        self.seen.update(partition, new_properties, prevs, jobs)
+        for prop, job in jobs.items():
+            # a property of several partitions may be notified already
+            self.jobs.setdefault(prop, job)
+        self.fingerprints.setdefault(partition, {}).update(
+            self.new_fingerprints.pop(partition, {}))
+        metrics.inc("new_properties_total", len(new_properties),
+                    site=partition)
+        self.poller.polled(partition)
         if len(new_properties) > 0:
             self.logger.info(
-                f"Found {len(new_properties)} new properties on {self.name}:"
+                f"Found {len(new_properties)} new properties on {partition}:"
                 f"{list(new_properties.keys())}")
-            prevs.update(new_properties)
-            self.shelf["prevs"] = prevs  # TODO check if this line is needed
-            self.shelf.sync()
         else:
-            self.logger.info(f"No new properties found on {self.name}")
-            if self.conf[f"{self.name}.test_send"]:
-                self.logger.debug(
-                    "Test sending with one of the latest seen properties")
-                new_properties = {k: v
-                                  for k, v in
-                                  list(all_properties.items())[0:1]}
-        return self.detailFinder.findFor(new_properties)
+            self.logger.info(f"No new properties found on {partition}")
+        if emit is not None:
+            for prop, url in kept.items():
+                emit(prop, url)
+        return all_properties, kept
+
+    def __find_all_new__(self,
+                         emit: Optional[Callable[[str, str], None]] = None
+                         ) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """
+          Search every partition of the website for new properties,
+          see __find_new__.
+        """
+        return self.__find_new__(
+            self.name,
+            lambda page_nb: self.search_page(page_nb, skip_unchanged=True),
+            emit)
+
+    def __test_send__(self, all_properties: Dict[str, str],
+                      new_properties: Dict[str, str]) -> Dict[str, str]:
+        if len(new_properties) == 0 and self.conf[f"{self.name}.test_send"]:
+            self.logger.debug(
+                "Test sending with one of the latest seen properties")
+            new_properties = {k: v
+                              for k, v in
+                              list(all_properties.items())[0:1]}
+        return new_properties
+
+    def detail(self, properties: Dict[str, str]) -> Dict[str, Details]:
+        """ Full details of the given properties, recorded in the history """
+        detailed = self.detailFinder.findFor(properties, engine=self.engine)
+        for prop, details in detailed.items():
+            if not isinstance(details, CompleteDetails):
+                continue
+            if self.history is not None:
+                self.history.record(self.name, prop, details)
+            job = self.jobs.get(prop)
+            if job is not None and job.state == DISCOVERED:
+                job.state = DETAILED
+                job.details = details
+        return detailed
+
+    def resume(self) -> Dict[str, Details]:
+        """
+          Properties found by earlier searches but never notified,
+          because the bot stopped or failed in the meantime.
+          Those not detailed yet are detailed now.
+          IDs and full details are returned.
+        """
+        unfinished = self.seen.journal(self.name)
+        if len(unfinished) == 0:
+            return {}
+        self.logger.info(f"Resuming {len(unfinished)} {self.name} "
+                         "properties never notified")
+        metrics.inc("resumed_total", len(unfinished), site=self.name)
+        self.jobs.update(unfinished)
+        resumed = {prop: job.details for prop, job in unfinished.items()
+                   if job.state == DETAILED}
+        resumed.update(self.detail({prop: job.url
+                                    for prop, job in unfinished.items()
+                                    if job.state == DISCOVERED}))
+        return resumed
+
+    def notified(self, properties: Iterable[str]) -> None:
+        """
+          Mark the given properties as notified, or as not to be
+          notified at all.
+        """
+        for prop in properties:
+            job = self.jobs.get(prop)
+            if job is not None:
+                job.state = NOTIFIED
+
+    def checkpoint(self) -> None:
+        """
+          Record the progress of the properties of this search,
+          in a single transaction.
+        """
+        if len(self.jobs) > 0:
+            self.seen.checkpoint(self.jobs)
+            self.jobs = {}
+
+    def search_new(self) -> Dict[str, Details]:
+        """
+          Method to search properties on given immo provider
+          and find only the new listings not previously found.
+          IDs and full details are returned.
+        """
+        all_properties, new_properties = self.__find_all_new__()
+        self.cards.clear()
+        return self.detail(self.__test_send__(all_properties,
+                                              new_properties))
+
+    def stream_new(self, emit: Callable[[str, str], None]) -> None:
+        """
+          Search new properties like search_new, but hand the ID and url
+          of each one to 'emit' as soon as found, without their details.
+        """
+        all_properties, new_properties = self.__find_all_new__(emit)
+        self.cards.clear()
+        for prop, url in self.__test_send__(all_properties,
+                                            new_properties).items():
+            if prop not in new_properties:
+                emit(prop, url)
+
+    def search_stream(self) -> Iterator[Tuple[str, Details]]:
+        """
+          Search new properties and yield them with their full details
+          one by one, as soon as each one is detailed.
+        """
+        return stream(self.conf, [self])
+
+    def price_drops(self) -> Dict[str, Tuple[int, CompleteDetails]]:
+        """
+          Fetch again the details of a sample of the properties already
+          reported, and find those whose price dropped by at least
+          'general.history.drop_threshold' (relative).
+          IDs, previous price and full details are returned.
+        """
+        if self.history is None:
+            return {}
+        due = self.history.due(self.name)
+        if len(due) == 0:
+            return {}
+        threshold = self.conf.get("general.history.drop_threshold", 0.03)
+        drops = {}
+        detailed = self.detailFinder.findFor(due, refresh=True,
+                                             engine=self.engine)
+        for prop, details in detailed.items():
+            if not isinstance(details, CompleteDetails):
+                continue
+            changes = self.history.record(self.name, prop, details)
+            old, new = changes.get("price", (None, None))
+            if old and new and new <= old * (1 - threshold):
+                drops[prop] = (old, details)
+        # do not retry right away the properties that could not be fetched
+        self.history.checked(self.name, due.keys())
+        metrics.inc("price_drops_total", len(drops), site=self.name)
+        self.logger.info(f"Re-checked {len(due)} {self.name} properties, "
+                         f"{len(drops)} dropped in price")
+        return drops
 
     def forget(self, properties: List[str]) -> None:
         """
@@ -83,24 +405,26 @@ class Searcher(ABC):
         When searching for new properties, these forgotten properties
         will reappear again.
         """
-        prevs_sanitized = {prop: v for prop, v in
-                           self.shelf["prevs"].items() if
-                           prop not in properties}
-        forgotten = [prop for prop in self.shelf["prevs"] if
-                     prop not in prevs_sanitized]
+        forgotten = self.seen.forget(self.name, properties)
+        # so that the pages listing them are read again
+        self.fingerprints.clear()
         self.logger.debug(f"The following {self.name} "
-                          f"properties about to be {forgotten = }")
-        self.shelf["prevs"] = prevs_sanitized
-        self.shelf.sync()
+                          f"properties were {forgotten = }")
 
 
 class MultiSearcher(Searcher):
     name = "MultiSearcher"
 
     def __init__(self, conf: ConfigFactory,
-                 searchers: List[Searcher]):
+                 searchers: List[Searcher],
+                 deduplicate: bool = False):
+        """
+        When 'deduplicate' is set, a property found on several websites
+        is only reported once, listing all of its urls.
+        """
         super().__init__(conf)
         self.searchers = searchers
+        self.deduplicate = deduplicate
 
     def __enter__(self):
         for searcher in self.searchers:
@@ -112,18 +436,128 @@ class MultiSearcher(Searcher):
             searcher.__exit__(exception_type, exception_value, traceback)
         # no particular treatment in case of exceptions
 
-    def search_all(self) -> List[str]:
+    def __run_all__(self, action: Callable[[Searcher], Dict]) -> Dict:
+        """
+        Run the given action on every searcher and merge their results.
+        Searchers are run concurrently on up to 'general.parallel.workers'
+        threads, each one being given at most 'general.parallel.timeout'
+        seconds. A searcher failing or running late is logged and skipped
+        so that it does not hold up the others.
+        Results are merged in the order of the searchers to stay
+        deterministic whatever the order in which they finished.
+        """
+        workers = self.conf.get("general.parallel.workers", 1)
+        timeout = self.conf.get("general.parallel.timeout", None)
+        started = {}
+
+        def run(searcher: Searcher) -> Dict:
+            started[searcher.name] = time.monotonic()
+            with metrics.timed("search_seconds", site=searcher.name):
+                return action(searcher)
+        executor = ThreadPoolExecutor(max_workers=workers,
+                                      thread_name_prefix="searcher")
+        futures = [(searcher, executor.submit(run, searcher))
+                   for searcher in self.searchers]
         res = {}
-        for searcher in self.searchers:
-            res.update(searcher.search_all())
+        for searcher, future in futures:
+            try:
+                res.update(self.__wait_for__(searcher, future,
+                                             started, timeout))
+            except TimeoutError:
+                self.logger.error(f"Searcher {searcher.name} timed out "
+                                  f"after {timeout}s, skipping its results")
+            except Exception:
+                self.logger.exception(f"Searcher {searcher.name} failed, "
+                                      "skipping its results")
+        # do not wait on searchers that timed out
+        executor.shutdown(wait=False, cancel_futures=True)
         return res
 
+    @staticmethod
+    def __wait_for__(searcher: Searcher, future: Future,
+                     started: Dict[str, float],
+                     timeout: Optional[float]) -> Dict:
+        """
+        Wait for the result of a searcher, its timeout only starting
+        to count once it actually started running.
+        A searcher still queued after a full timeout is given up on.
+        """
+        if timeout is None:
+            return future.result()
+        begun = started.get(searcher.name)
+        if begun is None:
+            try:
+                return future.result(timeout=timeout)
+            except TimeoutError:
+                begun = started.get(searcher.name)
+                if begun is None:
+                    raise
+        remaining = max(0, begun + timeout - time.monotonic())
+        return future.result(timeout=remaining)
+
+    def search_page(self, page_nb: int,
+                    skip_unchanged: bool = False) -> Dict[str, str]:
+        return self.__run_all__(
+            lambda searcher: searcher.search_page(page_nb, skip_unchanged))
+
+    def search_all(self) -> Dict[str, str]:
+        return self.__run_all__(lambda searcher: searcher.search_all())
+
     def search_new(self) -> Dict[str, Details]:
-        res = {}
-        for searcher in self.searchers:
-            res.update(searcher.search_new())
+        res = self.__run_all__(lambda searcher: searcher.search_new())
+        if self.deduplicate:
+            res = self.__collapse_duplicates__(res)
         return res
 
+    def search_stream(self) -> Iterator[Tuple[str, Details]]:
+        return stream(self.conf, self.searchers, self.deduplicate)
+
+    def price_drops(self) -> Dict[str, Tuple[int, CompleteDetails]]:
+        return self.__run_all__(lambda searcher: searcher.price_drops())
+
+    def resume(self) -> Dict[str, Details]:
+        return self.__run_all__(lambda searcher: searcher.resume())
+
+    def notified(self, properties: Iterable[str]) -> None:
+        properties = list(properties)
+        for searcher in self.searchers:
+            searcher.notified(properties)
+
+    def checkpoint(self) -> None:
+        for searcher in self.searchers:
+            searcher.checkpoint()
+
+    def __collapse_duplicates__(self,
+                                res: Dict[str, Details]) -> Dict[str, Details]:
+        """
+        Merge properties likely to be the same into the first one found,
+        and drop those which were already reported from another website.
+        """
+        collapsed = {}
+        reported = {}  # url -> details reported during this search
+        with open_index(self.conf) as index:
+            for prop, details in res.items():
+                if not isinstance(details, CompleteDetails):
+                    collapsed[prop] = details
+                    continue
+                fingerprint = Fingerprint.of(details)
+                same = index.find(details.url, fingerprint)
+                if same is None:
+                    index.add(details.url, fingerprint)
+                    collapsed[prop] = details
+                    reported[details.url] = details
+                elif same in reported:
+                    self.logger.info(f"Property {prop} is a duplicate "
+                                     f"of {same}, merging them")
+                    reported[same].other_urls += (details.url, )
+                    self.notified([prop])
+                else:
+                    self.logger.info(f"Property {prop} is a duplicate "
+                                     f"of already reported {same}, "
+                                     "skipping it")
+                    self.notified([prop])
+        return collapsed
+
     def forget(self, properties: List[str]) -> None:
         for searcher in self.searchers:
             searcher.forget(properties)
@@ -0,0 +1,351 @@
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+import dbm
+import hashlib
+import math
+import pickle
+import shelve
+import sqlite3
+import threading
+import time
+from logging import getLogger
+
+from cache import load
+from metrics import metrics
+
+# states of a new listing in the journal, until it is notified
+DISCOVERED = "discovered"
+DETAILED = "detailed"
+NOTIFIED = "notified"
+
+
+@dataclass(slots=True)
+class Job:
+    """ Progress of a new listing of a site towards being notified """
+    site: str
+    url: str
+    state: str = DISCOVERED
+    details: Optional[Any] = None
+
+
+class BloomFilter():
+    """
+    Compact set of ids telling whether an id was maybe added or surely
+    not, with about 'error' false positives once holding 'capacity' ids.
+    All the bits of an id lie in a single chunk of CHUNK bytes, so that
+    adding a few ids only changes (and needs saving) a few chunks.
+    """
+    CHUNK = 512
+
+    def __init__(self, capacity: int, error: float = 0.01,
+                 count: int = 0, version: int = 0):
+        self.capacity = capacity
+        size = max(8, int(-capacity * math.log(error) / math.log(2) ** 2))
+        self.chunks = -(-size // (self.CHUNK * 8))
+        self.hashes = max(1, round(size / capacity * math.log(2)))
+        self.bits = bytearray(self.chunks * self.CHUNK)
+        self.count = count
+        self.version = version
+        # chunks changed since last saved
+        self.dirty = set(range(self.chunks))
+
+    def __positions__(self, key: str) -> Iterator[int]:
+        # chunk and double hashing within it out of a single digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=24).digest()
+        bits = self.CHUNK * 8
+        start = int.from_bytes(digest[:8], "little") % self.chunks * bits
+        first = int.from_bytes(digest[8:16], "little")
+        step = int.from_bytes(digest[16:], "little") | 1
+        for i in range(self.hashes):
+            yield start + (first + i * step) % bits
+
+    def add(self, key: str) -> None:
+        for position in self.__positions__(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.dirty.add(position // (self.CHUNK * 8))
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        # stops at the first bit not set, most often the first one
+        for position in self.__positions__(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def chunk(self, index: int) -> bytes:
+        return bytes(self.bits[index * self.CHUNK:(index + 1) * self.CHUNK])
+
+    def load(self, index: int, bits: bytes) -> None:
+        self.bits[index * self.CHUNK:(index + 1) * self.CHUNK] = bits
+        self.dirty.discard(index)
+
+
+class SeenStore():
+    """
+    Store of all the listings ever seen by the bot,
+    indexed on (site, id) so that only the listings of the current search
+    have to be looked up or written, however long the history.
+    With a 'bloom_capacity', a persisted Bloom filter per site sized for
+    that many ids answers for the ids surely never seen, only the others
+    being looked up in the store.
+    """
+    # number of ids looked up at once, below sqlite's variables limit
+    BATCH = 500
+
+    def __init__(self, path: str, bloom_capacity: int = 0):
+        self.path = path
+        self.bloom_capacity = bloom_capacity
+        self.blooms: Dict[str, BloomFilter] = {}
+        self.logger = getLogger()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False)
+        # write ahead log lets readers go on while a searcher writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen ("
+                            " site TEXT NOT NULL,"
+                            " id TEXT NOT NULL,"
+                            " url TEXT,"
+                            " first_seen REAL NOT NULL,"
+                            " last_seen REAL NOT NULL,"
+                            " PRIMARY KEY (site, id))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS seen_arrivals "
+                            "ON seen (site, first_seen)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS migrations ("
+                            " source TEXT PRIMARY KEY,"
+                            " migrated REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS blooms ("
+                            " site TEXT PRIMARY KEY,"
+                            " capacity INTEGER NOT NULL,"
+                            " count INTEGER NOT NULL,"
+                            " version INTEGER NOT NULL,"
+                            " bits BLOB NOT NULL)")
+            # bits of the filters, 'bits' of blooms being left empty
+            self.db.execute("CREATE TABLE IF NOT EXISTS bloom_chunks ("
+                            " site TEXT NOT NULL,"
+                            " chunk INTEGER NOT NULL,"
+                            " version INTEGER NOT NULL,"
+                            " bits BLOB NOT NULL,"
+                            " PRIMARY KEY (site, chunk))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                            " site TEXT NOT NULL,"
+                            " id TEXT NOT NULL,"
+                            " url TEXT,"
+                            " state TEXT NOT NULL,"
+                            " details BLOB,"
+                            " PRIMARY KEY (site, id))")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    @classmethod
+    def __batches__(cls, ids: Iterable[str]) -> Iterable[List[str]]:
+        ids = list(ids)
+        for start in range(0, len(ids), cls.BATCH):
+            yield ids[start:start + cls.BATCH]
+
+    def __bloom__(self, site: str) -> BloomFilter:
+        """
+        Bloom filter of the site, up to date with the one persisted
+        (possibly by another process), built out of the store if missing
+        or too small. Only the chunks saved since the version held in
+        memory are read. To be called holding the lock.
+        """
+        row = self.db.execute("SELECT capacity, count, version, "
+                              "length(bits) FROM blooms WHERE site = ?",
+                              [site]).fetchone()
+        bloom = self.blooms.get(site)
+        if bloom is not None and row is not None and row[2] == bloom.version:
+            return bloom
+        # a non empty 'bits' was saved by an older version of the filter
+        if row is None or row[0] < self.bloom_capacity or row[1] > row[0] \
+                or row[3] > 0:
+            bloom = self.__build_bloom__(site, 0 if row is None else row[2])
+        else:
+            if bloom is None or bloom.capacity != row[0]:
+                bloom = BloomFilter(row[0])
+                bloom.version = -1
+            for index, bits in self.db.execute("SELECT chunk, bits "
+                                               "FROM bloom_chunks "
+                                               "WHERE site = ? "
+                                               "AND version > ?",
+                                               [site, bloom.version]):
+                bloom.load(index, bits)
+            bloom.count = row[1]
+            bloom.version = row[2]
+        self.blooms[site] = bloom
+        return bloom
+
+    def __build_bloom__(self, site: str, version: int) -> BloomFilter:
+        count = self.db.execute("SELECT COUNT(*) FROM seen WHERE site = ?",
+                                [site]).fetchone()[0]
+        bloom = BloomFilter(max(self.bloom_capacity, 2 * count),
+                            version=version)
+        for (prop, ) in self.db.execute("SELECT id FROM seen "
+                                        "WHERE site = ?", [site]):
+            bloom.add(prop)
+        self.db.execute("DELETE FROM bloom_chunks WHERE site = ?", [site])
+        self.__save_bloom__(site, bloom)
+        return bloom
+
+    def __save_bloom__(self, site: str, bloom: BloomFilter) -> None:
+        """ Save the chunks of the filter changed since last saved """
+        bloom.version += 1
+        self.db.execute("INSERT OR REPLACE INTO blooms "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [site, bloom.capacity, bloom.count, bloom.version,
+                         b""])
+        self.db.executemany("INSERT OR REPLACE INTO bloom_chunks "
+                            "VALUES (?, ?, ?, ?)",
+                            [(site, index, bloom.version, bloom.chunk(index))
+                             for index in sorted(bloom.dirty)])
+        bloom.dirty.clear()
+
+    def seen(self, site: str, ids: Iterable[str]) -> List[str]:
+        """ Return which ones of the given ids were already seen """
+        found = []
+        with self.lock, metrics.timed("seen_store_seconds", op="lookup"):
+            if self.bloom_capacity > 0:
+                with self.db:
+                    bloom = self.__bloom__(site)
+                ids = list(ids)
+                maybe = [prop for prop in ids if prop in bloom]
+                metrics.inc("seen_bloom_skipped_total",
+                            len(ids) - len(maybe), site=site)
+                ids = maybe
+            for batch in self.__batches__(ids):
+                marks = ",".join("?" * len(batch))
+                rows = self.db.execute("SELECT id FROM seen WHERE site = ? "
+                                       f"AND id IN ({marks})",
+                                       [site, *batch])
+                found.extend([row[0] for row in rows])
+        return found
+
+    def update(self, site: str, new: Dict[str, str],
+               current: Iterable[str] = (),
+               jobs: Optional[Dict[str, Job]] = None) -> None:
+        """
+        Record the new listings as seen and refresh the last time the
+        current ones were seen, all in a single transaction.
+        The jobs of the new listings to notify are written ahead in the
+        journal in that same transaction, so that none of them is ever
+        seen without being notified in the end.
+        """
+        now = time.time()
+        timer = metrics.timed("seen_store_seconds", op="update")
+        with timer, self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO seen "
+                                "(site, id, url, first_seen, last_seen) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                [(site, prop, url, now, now)
+                                 for prop, url in new.items()])
+            # a listing found again under another partition keeps its job
+            self.db.executemany("INSERT OR IGNORE INTO jobs "
+                                "(site, id, url, state) VALUES (?, ?, ?, ?)",
+                                [(job.site, prop, job.url, job.state)
+                                 for prop, job in (jobs or {}).items()])
+            if self.bloom_capacity > 0 and len(new) > 0:
+                # the seen table being locked for writing by now,
+                # nobody else can update the filter meanwhile
+                bloom = self.__bloom__(site)
+                for prop in new:
+                    # a filter just built holds them already
+                    if prop not in bloom:
+                        bloom.add(prop)
+                if bloom.count > bloom.capacity:
+                    bloom = self.__build_bloom__(site, bloom.version)
+                    self.blooms[site] = bloom
+                else:
+                    self.__save_bloom__(site, bloom)
+            for batch in self.__batches__(current):
+                marks = ",".join("?" * len(batch))
+                self.db.execute("UPDATE seen SET last_seen = ? "
+                                f"WHERE site = ? AND id IN ({marks})",
+                                [now, site, *batch])
+
+    def journal(self, site: str) -> Dict[str, Job]:
+        """ Listings of the site not notified yet, by id """
+        with self.lock:
+            rows = self.db.execute("SELECT site, id, url, state, details "
+                                   "FROM jobs WHERE site = ?",
+                                   [site]).fetchall()
+        jobs = {}
+        for site, prop, url, state, details in rows:
+            details = None if details is None else load(details)
+            if state == DETAILED and details is None:
+                state = DISCOVERED
+            jobs[prop] = Job(site, url, state, details)
+        return jobs
+
+    def checkpoint(self, jobs: Dict[str, Job]) -> None:
+        """
+        Record the progress of the given listings in the journal,
+        all in a single transaction. Notified ones are done with and
+        dropped from it.
+        """
+        timer = metrics.timed("seen_store_seconds", op="checkpoint")
+        with timer, self.lock, self.db:
+            self.db.executemany("DELETE FROM jobs WHERE site = ? AND id = ?",
+                                [(job.site, prop)
+                                 for prop, job in jobs.items()
+                                 if job.state == NOTIFIED])
+            self.db.executemany("UPDATE jobs SET state = ?, details = ? "
+                                "WHERE site = ? AND id = ?",
+                                [(job.state, pickle.dumps(job.details),
+                                  job.site, prop)
+                                 for prop, job in jobs.items()
+                                 if job.state == DETAILED])
+
+    def arrivals(self, site: str, since: float) -> int:
+        """
+        Number of listings first seen since the given time, leaving out
+        the ones found by the very first search of the site which were
+        not new then.
+        """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM seen "
+                                   "WHERE site = ? AND first_seen >= ? "
+                                   "AND first_seen > (SELECT MIN(first_seen) "
+                                   "FROM seen WHERE site = ?)",
+                                   [site, since, site]).fetchone()[0]
+
+    def forget(self, site: str, ids: Iterable[str]) -> List[str]:
+        """ Forget the given ids, returning those that were known """
+        forgotten = self.seen(site, ids)
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM seen WHERE site = ? AND id = ?",
+                                [(site, prop) for prop in forgotten])
+        return forgotten
+
+    def migrate_shelve(self, site: str, shelve_path: str) -> None:
+        """
+        Import the listings of the shelve file used by older versions
+        of the bot. This is only ever done once per shelve file,
+        which is left untouched.
+        """
+        with self.lock:
+            done = self.db.execute("SELECT 1 FROM migrations "
+                                   "WHERE source = ?",
+                                   [shelve_path]).fetchone()
+        if done is not None or not dbm.whichdb(shelve_path):
+            return
+        with shelve.open(shelve_path, flag="r") as shelf:
+            prevs = shelf.get("prevs", {})
+        self.logger.info(f"Migrating {len(prevs)} {site} properties "
+                         f"from {shelve_path}")
+        self.update(site, prevs)
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO migrations VALUES (?, ?)",
+                            [shelve_path, time.time()])
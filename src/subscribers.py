@@ -0,0 +1,107 @@
+from pyhocon import ConfigFactory
+from bisect import bisect_right
+from typing import Dict
+from typing import FrozenSet
+from typing import List
+from typing import Optional
+from dataclasses import dataclass
+from logging import getLogger
+
+from details import CompleteDetails
+from details import Details
+from dedup import postal_codes
+
+# names of the postal codes, min and max price params of each website
+SITE_CRITERIA = {"immoweb": ("postalCodes", "minPrice", "maxPrice"),
+                 "immovlan": ("towns", "minprice", "maxprice"),
+                 "realo": ("postalCodes", "priceMin", "priceMax")}
+
+
+@dataclass(frozen=True)
+class Subscription:
+    """
+    Search criteria of one subscriber, and the telegram-send configuration
+    of the chat new properties are sent to (the default one if None).
+    """
+    name: str
+    chat: Optional[str]
+    postal_codes: FrozenSet[str]
+    min_price: int
+    max_price: int
+
+
+def load_subscriptions(conf: ConfigFactory) -> List[Subscription]:
+    """ Subscriptions listed under 'subscribers', if any """
+    return [Subscription(name=sub["name"],
+                         chat=sub.get("telegram_conf", None),
+                         postal_codes=frozenset([str(pc) for pc in
+                                                 sub["postalCodes"]]),
+                         min_price=sub["minPrice"],
+                         max_price=sub["maxPrice"])
+            for sub in conf.get("subscribers", [])]
+
+
+def share_search(conf: ConfigFactory,
+                 subscriptions: List[Subscription]) -> None:
+    """
+    Replace the search criteria of every website with the union of the
+    subscriptions, so that every location is crawled once for all.
+    """
+    postal_codes = sorted(set().union(*[sub.postal_codes
+                                        for sub in subscriptions]))
+    postal_codes = [int(pc) for pc in postal_codes]
+    min_price = min([sub.min_price for sub in subscriptions])
+    max_price = max([sub.max_price for sub in subscriptions])
+    conf.put("search.postalCodes", postal_codes)
+    conf.put("search.minPrice", min_price)
+    conf.put("search.maxPrice", max_price)
+    for site, (codes, low, high) in SITE_CRITERIA.items():
+        if site in conf:
+            conf.put(f"{site}.search.{codes}", postal_codes)
+            conf.put(f"{site}.search.{low}", min_price)
+            conf.put(f"{site}.search.{high}", max_price)
+    getLogger().info(f"Searching for {len(subscriptions)} subscribers in "
+                     f"{postal_codes} between {min_price} and {max_price}")
+
+
+class SubscriptionIndex():
+    """
+    Subscriptions indexed on postal code then sorted on min price,
+    so that a property is only checked against the subscriptions of
+    its location whose price range may hold it.
+    """
+
+    def __init__(self, subscriptions: List[Subscription]):
+        self.subscriptions = subscriptions
+        by_postal_code: Dict[str, List[Subscription]] = {}
+        for sub in subscriptions:
+            for postal_code in sub.postal_codes:
+                by_postal_code.setdefault(postal_code, []).append(sub)
+        self.by_postal_code = {
+            postal_code: sorted(subs, key=lambda sub: sub.min_price)
+            for postal_code, subs in by_postal_code.items()}
+        self.min_prices = {
+            postal_code: [sub.min_price for sub in subs]
+            for postal_code, subs in self.by_postal_code.items()}
+
+    def __len__(self) -> int:
+        return len(self.subscriptions)
+
+    def match(self, details: Details) -> List[Subscription]:
+        """
+        Subscriptions interested in the property.
+        A property whose location or price could not be read is sent to
+        every subscriber rather than risk missing it.
+        """
+        if not isinstance(details, CompleteDetails) or\
+                details.price is None:
+            return self.subscriptions
+        postal_code = next((candidate for candidate
+                            in postal_codes(details.address)
+                            if candidate in self.by_postal_code), None)
+        if postal_code is None:
+            return self.subscriptions
+        subs = self.by_postal_code[postal_code]
+        candidates = subs[:bisect_right(self.min_prices[postal_code],
+                                        details.price)]
+        return [sub for sub in candidates if details.price <= sub.max_price]
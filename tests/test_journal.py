@@ -0,0 +1,46 @@
+import os
+import sys
+
+from pyhocon import ConfigFactory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+from polling import Poller  # noqa: E402
+from search import Searcher  # noqa: E402
+from seen import SeenStore  # noqa: E402
+
+URL = "https://www.realo.be/en/rue-royale-81-1000-brussels/103600"
+
+
+class LocationsSearcher(Searcher):
+    """ Searcher of a website partitioned by location, like realo """
+    name = "locations"
+
+    def search_page(self, page_nb: int):
+        return {}
+
+
+def searcher(path: str) -> Searcher:
+    conf = ConfigFactory.from_dict({"general": {"pagination": {
+        "max_pages": 1}}})
+    searcher = LocationsSearcher(conf)
+    searcher.seen = SeenStore(path)
+    searcher.poller = Poller(conf, searcher.seen)
+    return searcher
+
+
+def test_property_of_two_locations_is_not_resumed_once_notified(tmp_path):
+    path = str(tmp_path / "seen.sqlite")
+    first = searcher(path)
+    first.__find_new__("locations1000", lambda page_nb: {"103600": URL})
+    first.notified(["103600"])
+    # found again under another location after being notified
+    first.__find_new__("locations1050", lambda page_nb: {"103600": URL})
+    first.checkpoint()
+    first.seen.close()
+
+    restarted = searcher(path)
+    assert restarted.seen.journal("locations") == {}
+    assert restarted.resume() == {}
+    restarted.seen.close()